@@ -17,14 +17,17 @@ import mathutils
 from decimal import Decimal
 from collections import defaultdict
 from pathlib import Path
+import os
 from os.path import basename, dirname
 from .import_jkl import Level
 from .import_3do import Thing
 from .import_mat import Mat
-from .import_gob import Gob
+from .import_gob import open_gob, close_gobs
 from .import_bm import Bm
 from .import_sft import Sft
-from .import_cmp import Cmp
+from .import_cmp import Cmp, shared_colormap, clear_colormaps
+from . import jk_pvs
+from . import jk_image
 from bpy_extras.io_utils import ImportHelper
 from bpy.props import StringProperty, IntProperty, BoolProperty, EnumProperty
 from bpy.props import FloatProperty, CollectionProperty
@@ -57,7 +60,7 @@ bl_info = {
 # resolve 3do hierarchy and parenting     DONE
 # parse GOB/GOO                           DONE
 # read in template structure              TODO
-# separate into sectors                   TODO
+# separate into sectors                   DONE
 
 
 class JKLAddon_Prefs(AddonPreferences):
@@ -78,7 +81,8 @@ class JKLAddon_Prefs(AddonPreferences):
     temp_folder: StringProperty(
         name="Temporary image folder",
         description="Temporary folder for texture files. Neccessary, if "
-        "textures need to be packed in an fbx",
+        "textures need to be packed in an fbx. Also holds the cached "
+        "archive file lists",
         subtype='DIR_PATH',
         default=""
     )
@@ -96,6 +100,20 @@ class JKLAddon_Prefs(AddonPreferences):
             "may need one, if you want to export an fbx with packed textures."
             )
         layout.prop(self, "temp_folder")
+        layout.operator(PREFERENCES_OT_jk_clear_texture_cache.bl_idname)
+
+
+class PREFERENCES_OT_jk_clear_texture_cache(Operator):
+    """Remove the decoded textures cached in the temporary image folder"""
+    bl_idname = "preferences.jk_clear_texture_cache"
+    bl_label = "Clear Texture Cache"
+    bl_options = {'INTERNAL'}
+
+    def execute(self, context):
+        prefs = context.preferences.addons[__name__].preferences
+        removed = jk_image.clear_texture_cache(prefs.temp_folder)
+        self.report({'INFO'}, str(removed) + " cached textures removed")
+        return {'FINISHED'}
 
 
 class ImportGOBfile(Operator):
@@ -328,6 +346,37 @@ class POPUP_OT_gob_browser(Operator):
         default=False,
     )
 
+    split_sectors: BoolProperty(
+        name="Split by sector",
+        description="One object per sector in a level collection, "
+        "so the viewport can cull and update sectors separately",
+        default=False,
+    )
+
+    cull_adjoins: BoolProperty(
+        name="Cull adjoins",
+        description="Adjoin (portal) surfaces without geometry or material "
+        "are left out of the level mesh",
+        default=False,
+    )
+
+    cluster_size: IntProperty(
+        name="Sectors per object",
+        description="Adjacent sectors joined into one object when split "
+        "by sector, at most this many (1 = one object per sector)",
+        default=1,
+        min=1,
+    )
+
+    pvs_depth: IntProperty(
+        name="PVS depth",
+        description="Adjoins deep a sector sees for the sector visibility "
+        "culling, 0 = unlimited. A limit is only an approximation and may "
+        "hide sectors that are visible",
+        default=0,
+        min=0,
+    )
+
     in_text_editor: BoolProperty(
         name="load into Text Editor",
         description="Raw text gets loaded into blender's Text Editor, "
@@ -369,7 +418,8 @@ class POPUP_OT_gob_browser(Operator):
 
     def invoke(self, context, event):
         global gob
-        gob = Gob(self.filepath)
+        prefs = bpy.context.preferences.addons[__name__].preferences
+        gob = open_gob(self.filepath, prefs.temp_folder or None)
 
         # The following feels a bit awkward.
         # Put all files from thegob into defaultdict,
@@ -481,6 +531,11 @@ class POPUP_OT_gob_browser(Operator):
         box_jkl.prop(self, "import_mats")
         box_jkl.prop(self, "import_intensities")
         box_jkl.prop(self, "import_sector_info")
+        box_jkl.prop(self, "split_sectors")
+        if self.split_sectors:
+            box_jkl.prop(self, "cluster_size")
+            box_jkl.prop(self, "pvs_depth")
+        box_jkl.prop(self, "cull_adjoins")
         box_jkl.prop(self, "import_scale")
         box_jkl.prop(self, "manual_source_override")
         if self.manual_source_override:
@@ -500,8 +555,8 @@ class POPUP_OT_gob_browser(Operator):
 
         prefs = bpy.context.preferences.addons[__name__].preferences
 
-        jkdf_res = prefs.jkdf_path + "\Res2.gob"
-        mots_res = prefs.mots_path + "\JKMRES.GOO"
+        jkdf_res = os.path.join(prefs.jkdf_path, "Res2.gob")
+        mots_res = os.path.join(prefs.mots_path, "JKMRES.GOO")
 
         restwo_file = Path(jkdf_res)
         if restwo_file.is_file():
@@ -520,7 +575,7 @@ class POPUP_OT_gob_browser(Operator):
 
         ungobed_file = gob.ungob(filename)
         try:
-            ungobed_palette = gob.ungob(self.palette_file)
+            palette = shared_colormap(gob.ungob(self.palette_file))
         except:
             pass
 
@@ -536,13 +591,13 @@ class POPUP_OT_gob_browser(Operator):
             # replace break characters, otherwise
             # line feed & carriage return bytes
             # are interpreted as a 16bit wide box character
-            decoded_text = ungobed_file.decode("iso-8859-1").splitlines()
+            decoded_text = str(ungobed_file, "iso-8859-1").splitlines()
             text.write('\n'.join(decoded_text))
             text.cursor_set(0)
 
         if ext == "jkl":
             level = Level(
-                self.filepath + "\\" + filename,
+                os.path.join(self.filepath, filename),
                 self.import_things,
                 self.import_mats,
                 self.import_intensities,
@@ -551,7 +606,12 @@ class POPUP_OT_gob_browser(Operator):
                 self.import_scale,
                 self.select_shader,
                 self.import_sector_info,
-                self.source_mots
+                self.source_mots,
+                gob_file=self.filepath,
+                split_sectors=self.split_sectors,
+                cull_adjoins=self.cull_adjoins,
+                pvs_depth=self.pvs_depth,
+                cluster_size=self.cluster_size
                 )
             level.open_from_gob(ungobed_file)
             level.import_Level()
@@ -577,7 +637,7 @@ class POPUP_OT_gob_browser(Operator):
         elif ext == "mat":
             mat = Mat(
                 ungobed_file,
-                ungobed_palette,
+                palette,
                 self.import_alpha,
                 filename,
                 self.select_shader,
@@ -585,25 +645,29 @@ class POPUP_OT_gob_browser(Operator):
                 None                # flag ?
                 )
             mat.import_Mat()
+            jk_image.flush_pngs(bpy.data.images)
             self.report(
                 {'INFO'},
                 "Material \"" + filename[:-4] + "\" imported"
                 )
 
         elif ext == "bm":
-            res_gob = Gob(jkdf_res)
-            ungobed_ui_palette = res_gob.ungob("uicolormap.cmp")
-            bm = Bm(ungobed_file, filename, ungobed_ui_palette)
+            res_gob = open_gob(jkdf_res, prefs.temp_folder or None, use_mmap=True)
+            ui_palette = shared_colormap(res_gob.ungob("uicolormap.cmp"))
+            bm = Bm(ungobed_file, filename, ui_palette)
             bm.import_Bm()
 
         elif ext == "sft":
-            res_gob = Gob(jkdf_res)
-            ungobed_ui_palette = res_gob.ungob("uicolormap.cmp")
-            sft = Sft(ungobed_file, filename, ungobed_ui_palette)
+            res_gob = open_gob(jkdf_res, prefs.temp_folder or None, use_mmap=True)
+            ui_palette = shared_colormap(res_gob.ungob("uicolormap.cmp"))
+            sft = Sft(ungobed_file, filename, ui_palette)
             sft.import_Sft()
 
         elif ext == "cmp":
-            colormap = Cmp(ungobed_file, filename)
+            colormap = Cmp(
+                shared_colormap(ungobed_file),
+                filename
+                )
             colormap.import_Cmp()
 
         elif ext == "wav":
@@ -615,6 +679,55 @@ class POPUP_OT_gob_browser(Operator):
         return {'FINISHED'}
 
 
+class VIEW3D_OT_jk_sector_visibility(Operator):
+    """Hide the sector objects of split levels that aren't visible from the camera's sector"""
+    bl_idname = "view3d.jk_sector_visibility"
+    bl_label = "JK Sector Visibility"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    show_all: BoolProperty(
+        name="Show all",
+        description="Reveal every sector object again",
+        default=False,
+    )
+
+    def execute(self, context):
+        scene = context.scene
+        levels = scene.get("jk_levels", {})
+        camera = scene.camera
+        if camera is None and not self.show_all:
+            self.report({'WARNING'}, "Scene has no camera")
+            return {'CANCELLED'}
+
+        visible = {}
+        for name, level in levels.items():
+            if "pvs" in level and not self.show_all:
+                visible[name] = jk_pvs.visible_from(level, camera.matrix_world.translation)
+
+        hidden = 0
+        for ob in scene.objects:
+            if "jk_sectors" not in ob or ob.get("jk_level") not in levels:
+                continue
+            members = list(ob["jk_sectors"])
+            sectors = visible.get(ob["jk_level"])
+            # camera outside of the level or surfaces without sector: shown,
+            # a cluster is shown if any of its sectors is visible
+            hide = (
+                sectors is not None
+                and all(member > -1 for member in members)
+                and not any(sectors[member] for member in members)
+                )
+            ob.hide_set(hide)
+            hidden += hide
+
+        self.report({'INFO'}, str(hidden) + " sector objects hidden")
+        return {'FINISHED'}
+
+
+def sector_visibility_button(self, context):
+    self.layout.operator(VIEW3D_OT_jk_sector_visibility.bl_idname)
+
+
 def import_gob_button(self, context):
     self.layout.operator(
         ImportGOBfile.bl_idname,
@@ -624,6 +737,7 @@ def import_gob_button(self, context):
 
 def register():
 
+    bpy.utils.register_class(PREFERENCES_OT_jk_clear_texture_cache)
     bpy.utils.register_class(JKLAddon_Prefs)
     bpy.utils.register_class(ImportGOBfile)
     bpy.utils.register_class(ImportException)
@@ -632,12 +746,15 @@ def register():
     bpy.utils.register_class(POPUP_OT_gob_browser)
     bpy.utils.register_class(GOB_UL_List)
     bpy.utils.register_class(GOB_UL_Dir_List)
+    bpy.utils.register_class(VIEW3D_OT_jk_sector_visibility)
     bpy.types.TOPBAR_MT_file_import.append(import_gob_button)
+    bpy.types.VIEW3D_MT_view.append(sector_visibility_button)
 
 
 def unregister():
 
     bpy.utils.unregister_class(JKLAddon_Prefs)
+    bpy.utils.unregister_class(PREFERENCES_OT_jk_clear_texture_cache)
     bpy.utils.unregister_class(ImportGOBfile)
     bpy.utils.unregister_class(ImportException)
     bpy.utils.unregister_class(File_Item)
@@ -645,7 +762,12 @@ def unregister():
     bpy.utils.unregister_class(POPUP_OT_gob_browser)
     bpy.utils.unregister_class(GOB_UL_List)
     bpy.utils.unregister_class(GOB_UL_Dir_List)
+    bpy.utils.unregister_class(VIEW3D_OT_jk_sector_visibility)
     bpy.types.TOPBAR_MT_file_import.remove(import_gob_button)
+    bpy.types.VIEW3D_MT_view.remove(sector_visibility_button)
+    close_gobs()
+    clear_colormaps()
+    jk_image.shutdown_png_writer()
 
 
 if __name__ == '__main__':
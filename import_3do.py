@@ -1,9 +1,14 @@
 import re
 import bpy
+import numpy as np
 from math import *
+import os
 from os.path import basename, dirname
-from .import_gob import Gob
+from .import_gob import open_gob
 from .import_mat import Mat
+from .import_cmp import shared_colormap
+from . import jk_mesh
+from . import jk_image
 
 class Thing:
 
@@ -66,7 +71,7 @@ class Thing:
 
     def import_Thing(self):
         '''read in and build 3do mesh'''
-        ungobed_string = self.file.decode("ISO-8859-1")
+        ungobed_string = str(self.file, "ISO-8859-1")
         lines = re.split('\n', ungobed_string)
         del ungobed_string
 
@@ -88,35 +93,43 @@ class Thing:
 
         i=0
         matLine = ""
-        matList = []
+        matFiles = []       # material file names as noted in the 3do
+        matList = []        # blender material names
         while i < materialCount:
 
             if self.motsflag:
                 matLine = re.split("\s+", lines[i+matPos],)
-                matLine[1] = matLine[1].replace(".MAT", "")          # :P
-                matList.append(matLine[1].replace(".mat", ""))
+                matFiles.append(matLine[1])
             else:
                 matLine = re.split("\s+", lines[i+matPos+1],)
-                matLine[2] = matLine[2].replace(".MAT", "")
-                matList.append(matLine[2].replace(".mat", ""))
+                matFiles.append(matLine[2])
+            matList.append(matFiles[-1].lower().replace(".mat", ""))
 
             i+=1
 
         if self.import_textures:
             this_addon = basename(dirname(__file__))
             prefs = bpy.context.preferences.addons[this_addon].preferences
-            gob = Gob(prefs.jkdf_path + "\Res2.gob")
-            ungobed_palette = gob.ungob("01narsh.cmp")
-            for texture in matList:
+            res_gob = os.path.join(prefs.jkdf_path, "Res2.gob")
+            gob = open_gob(res_gob, prefs.temp_folder or None, use_mmap=True)
+            palette = shared_colormap(gob.ungob("01narsh.cmp"))
+            for texture, texture_file in zip(matList, matFiles):
                 if bpy.data.materials.get(texture):
                     continue
                 else:
-                    ungobed_file = gob.ungob(texture.lower()+".mat")
-                    mat = Mat(ungobed_file, ungobed_palette, False, texture.lower(), "BSDF", True, None)
+                    ungobed_file = gob.ungob(texture_file)
+                    mat = Mat(ungobed_file, palette, False, texture, "BSDF", True, None)
                     mat.import_Mat()
+            # temp folder textures are written before the import returns
+            jk_image.flush_pngs(bpy.data.images)
+            jk_image.trim_texture_cache(prefs.temp_folder)
 
 
 
+        # (width, height, x tile, y tile) of every material
+        textures = jk_mesh.texture_table(matList, default_size=64.0)
+
+
         # get the number of meshes ##########################################
 
         meshCount = 0
@@ -370,15 +383,10 @@ class Thing:
 
             obj_list.append(ob)
 
-            # add vertex color layer
-            vcol = me.vertex_colors.new(name='Intensities')
-
-            # Add materials to meshes
+            # Add materials to meshes, empty slot for missing materials
+            # to keep the 3do material indices
             for material in matList:
-                try:
-                    ob.data.materials.append(bpy.data.materials[material.lower()])
-                except:
-                    pass
+                ob.data.materials.append(bpy.data.materials.get(material))
 
             # offset has to be applied to root object
             ob.location = (x + self.xOffs, y + self.yOffs, z + self.zOffs)
@@ -392,30 +400,33 @@ class Thing:
             # Link object to scene
             scene = bpy.context.scene
             scene.collection.objects.link(ob)
-            me.from_pydata(vert_array, [], surf_array)
 
+            loop_total = np.array([len(surface) for surface in surf_array], dtype=np.int32)
+            loop_start = np.cumsum(loop_total) - loop_total
+            jk_mesh.build_mesh(
+                me,
+                np.array(vert_array, dtype=np.float32).reshape((-1, 3)),
+                loop_start,
+                loop_total,
+                np.array([v for surface in surf_array for v in surface], dtype=np.int32)
+                )
 
-            # add uv map
-            me.uv_layers.new(name="UVMap")
-            uvMap = me.uv_layers["UVMap"]
-
-
-            # TODO Test, if texture exists!!!
             # assign every needed material to faces
-            for isrf, surface in enumerate(surf_array):
-                polygon = me.polygons[isrf]
-                polygon.material_index = surf_material[isrf]
-                currenttexture = matList[surf_material[isrf]].lower()
-                try:
-                    textureSize = bpy.data.images[currenttexture].size
-                except:
-                    textureSize = (64,64)
-                # add uv data
-                for jsrf, loop in enumerate(uv_indices[isrf]):
-                    u = float(uvArray[uv_indices[isrf][jsrf]][0])
-                    v = float(uvArray[uv_indices[isrf][jsrf]][1])
-                    uvMap.data[polygon.loop_indices[jsrf]].uv = (u / textureSize[0], v /-textureSize[1])
+            surf_material = np.array(surf_material, dtype=np.int32)
+            me.polygons.foreach_set("material_index", surf_material)
 
+            # add uv map
+            loop_face = np.repeat(np.arange(len(surf_array)), loop_total)
+            uvs = jk_mesh.loop_uvs(
+                np.array([uv[:2] for uv in uvArray], dtype=np.float32).reshape((-1, 2)),
+                np.array([uv for surface in uv_indices for uv in surface], dtype=np.int32),
+                surf_material[loop_face],
+                textures
+                )
+            jk_mesh.set_uvs(me, uvs, "UVMap")
+
+            # add vertex color layer
+            jk_mesh.set_colors(me, np.ones((len(uvs), 4), dtype=np.float32), 'Intensities')
 
             # Update mesh with new data
             me.update()
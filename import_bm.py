@@ -1,21 +1,24 @@
 from struct import unpack
 import numpy as np
 import bpy
+from os.path import basename, dirname
+from . import jk_image
 
 
 class Bm:
 
-    def __init__(self, bm, name, ext_pal):
+    def __init__(self, bm, name, colormap):
+        '''takes the decoded Colormap for bitmaps without own palette'''
 
         self.file = bm
         self.name = name.replace(".bm", "")
-        self.palette = ext_pal
+        self.colormap = colormap
 
     def import_Bm(self):
 
-        header = unpack("ccccLLLLLLLLLLLLLLLLLL", self.file[0:76])
+        header = unpack("<ccccLLLLLLLLLLLLLLLLLL", self.file[0:76])
 
-        size_x, size_y = unpack("LL", self.file[128:136])
+        size_x, size_y = unpack("<LL", self.file[128:136])
 
         PalInc = header[6]              # 0, 1 or 2 ;  2 = palette
         NumImages = header[7]           # number of images in file
@@ -44,7 +47,19 @@ class Bm:
             height=size_y
             )
 
-        if NumBits == 16:
+        # one float32 rgba buffer, filled in place
+        pixels = jk_image.pixel_buffer(size_y, size_x)
+
+        # decoded images are cached by file and colormap
+        this_addon = basename(dirname(__file__))
+        prefs = bpy.context.preferences.addons[this_addon].preferences
+        cache_key = jk_image.texture_key(self.file, self.colormap.digest)
+        cached = jk_image.load_textures(prefs.temp_folder, cache_key)
+
+        if cached is not None:
+            jk_image.from_uint8(cached['diffuse'], out=pixels)
+
+        elif NumBits == 16:
             # reshape flat array to 2d matrix for flipping
             flipped_img16 = np.frombuffer(
                 self.file,
@@ -56,19 +71,7 @@ class Bm:
             # image flipped, starts top left in sith engine
             # blender images start bottom left
             img = np.flipud(flipped_img16)
-            flat_img16 = img.reshape((img_size, 1))
-
-            # first 5 of 16 bit for red channel
-            r = ((flat_img16 & 0b1111100000000000) >> 11) / 31
-            # 6 of 16 bit for green channel
-            g = ((flat_img16 & 0b0000011111100000) >> 6) / 31
-            # last 5 of 16 bit for blue channel
-            b = (flat_img16 & 0b0000000000011111) / 31
-            # transparency bool for "Transparent" index, recast to int 0 or 1
-            a = (flat_img16 != Transparent).astype(int)
-
-            col_image = np.hstack((r, g, b, a))
-            pixels = col_image.flatten()
+            jk_image.decode_16bit(img, Transparent, pixels)
 
         else:
             img = np.frombuffer(
@@ -77,6 +80,7 @@ class Bm:
                 count=img_size,
                 offset=img_start
                 ).reshape((size_y, size_x))
+            # flipped view, blender images start bottom left
             img_matrix = np.flipud(img)
 
             if PalInc == 2:
@@ -87,17 +91,12 @@ class Bm:
                     offset=palette_start
                     ).reshape((256, 3)) / 255
             else:
-                pal = np.frombuffer(
-                    self.palette,
-                    dtype=np.uint8,
-                    count=256*3,
-                    offset=64).reshape((256, 3)) / 255
+                pal = self.colormap.rgb
 
-            a = np.ones((256, 1))
-            a[Transparent][0] = 0.0
-            pal_alpha_channel = np.hstack((pal, a))
+            pal_alpha_channel = jk_image.palette_table(pal, Transparent)
+            jk_image.gather(pal_alpha_channel, img_matrix, pixels)
 
-            col_image = pal_alpha_channel[img_matrix]
-            pixels = col_image.flatten()
+        if cached is None and prefs.temp_folder:
+            jk_image.save_textures(prefs.temp_folder, cache_key, diffuse=jk_image.to_uint8(pixels))
 
-        image.pixels = pixels
+        jk_image.set_pixels(image, pixels)
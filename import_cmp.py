@@ -1,31 +1,90 @@
+import hashlib
 from struct import unpack
 import numpy as np
 import bpy
+from . import jk_image
+
+
+# colormap layout: 64 byte header, 256 rgb colors, 64 light level tables
+# (palette index per color and level), optionally 256 transparency tables
+
+CMP_HEADER_LEN = 64
+CMP_LIGHT_LEVELS = 64
+
+
+class Colormap:
+    '''decoded colormap (.cmp) with float32 lookup tables indexed by
+    palette index, shared by all bitmaps that use the same cmp'''
+
+    def __init__(self, cmp):
+        data = np.frombuffer(cmp, dtype=np.uint8)
+        header = unpack("<ccccLL", cmp[0:12])
+        self.transparency = header[5]
+        self.digest = hashlib.sha1(data).hexdigest()
+
+        # rgb of every palette color
+        self.rgb = data[CMP_HEADER_LEN:CMP_HEADER_LEN + 256*3].reshape((256, 3)) / np.float32(255)
+
+        # palette index of every color at every light level, 0 = darkest
+        self.light_levels = data[
+            CMP_HEADER_LEN + 256*3:CMP_HEADER_LEN + 256*3 + 256*CMP_LIGHT_LEVELS
+            ].reshape((CMP_LIGHT_LEVELS, 256))
+
+        # rgb of every color at every light level (64, 256, 3)
+        self.light_rgb = self.rgb[self.light_levels]
+
+        # alpha values from the last light level table
+        self.alpha = self.light_levels[-1] / np.float32(63)
+
+        # rgba tables, opaque and with alpha
+        self.rgba = np.ones((256, 4), dtype=np.float32)
+        self.rgba[:, :3] = self.rgb
+        self.rgba_alpha = self.rgba.copy()
+        self.rgba_alpha[:, 3] = self.alpha
+
+        # emissive color: the color a pixel keeps at light level 0
+        self.emissive = np.ones((256, 4), dtype=np.float32)
+        self.emissive[:, :3] = self.light_rgb[0]
+
+    def rgba_table(self, alpha=False):
+        '''rgba lookup table, alpha from the transparency light level'''
+        return self.rgba_alpha if alpha else self.rgba
+
+
+# colormaps are decoded once per session, by the sha1 of the cmp file,
+# so an edited cmp is decoded again wherever it is taken from
+
+colormaps = {}      # sha1 hex digest -> Colormap
+
+
+def shared_colormap(cmp):
+    '''returns the Colormap of the cmp file bytes,
+    only decoded if it isn't cached yet'''
+    digest = hashlib.sha1(cmp).hexdigest()
+    colormap = colormaps.get(digest)
+    if colormap is None:
+        colormap = Colormap(cmp)
+        colormaps[digest] = colormap
+    return colormap
+
+
+def clear_colormaps():
+    colormaps.clear()
 
 
 class Cmp:
 
-    def __init__(self, cmp, name):
-        self.file = cmp
+    def __init__(self, colormap, name):
+        '''takes a decoded Colormap'''
+        self.colormap = colormap
         self.name = name.replace(".cmp", "")
 
     def import_Cmp(self):
 
-        header = unpack("ccccLL", self.file[0:12])
-
-        Transparency = header[5]
-
         image = bpy.data.images.new(
             name=self.name,
             width=16,
             height=16
             )
 
-        pixels = np.frombuffer(
-                self.file,
-                dtype=np.uint8,
-                count=256*3,
-                offset=64
-                ).reshape((256,3)) / 255
-
-        image.pixels = np.hstack((pixels, np.ones((256, 1)))).flatten()
+        jk_image.set_pixels(image, self.colormap.rgba)
@@ -1,82 +1,291 @@
-from struct import unpack
+import hashlib
+import mmap
+import os
+from collections import OrderedDict
+from struct import unpack_from
+import numpy as np
+
+
+# GOB directory entry: file offset, file length, zero padded file path
+GOB_ENTRY = np.dtype([
+    ('offset', '<u4'),
+    ('length', '<u4'),
+    ('name', 'S128')
+    ])
+
+
+def toc_keys(entries):
+    '''batch normalises the directory names of a GOB_ENTRY array to
+    lookup keys (lower case file name without directory).
+    Returns the keys sorted ascending and the entry index of each key'''
+    names = np.array(entries['name']).view(np.uint8).reshape((-1, 128))
+    names = names.copy()
+
+    # cut everything after the first \x00
+    names[np.cumsum(names == 0, axis=1) > 0] = 0
+
+    # ascii lower case
+    names += ((names >= 65) & (names <= 90)).astype(np.uint8) * 32
+
+    # strip directories: shift every name left past its last backslash
+    backslash = names == 92
+    start = np.where(
+        backslash.any(axis=1),
+        128 - np.argmax(backslash[:, ::-1], axis=1),
+        0
+        )
+    columns = start[:, None] + np.arange(128)
+    keys = np.take_along_axis(names, np.minimum(columns, 127), axis=1)
+    keys[columns > 127] = 0
+
+    keys = keys.view('S128').ravel()
+    order = np.argsort(keys, kind='stable')
+    return keys[order], order
 
 
 class Gob:
     '''extract single files from GOB/GOO container file''',
 
-    def __init__(self, gob_file):
+    def __init__(self, gob_file, use_mmap=False, cache_dir=None):
         '''
-        Initialize GOB / GOO container file
+        Initialize GOB / GOO container file. Only the directory and the
+        files that are actually extracted are read, the archive is opened
+        for each read and not kept open. With use_mmap it is memory-mapped
+        instead and stays open until close(). With cache_dir the parsed toc
+        is kept in a sidecar file there and reused while size and mtime of
+        the archive are unchanged.
         '''
+        self.gob_file = gob_file
         f = open(gob_file, 'rb')  # open file for reading
-        self.data = f.read()
+        stat = os.fstat(f.fileno())
+        self.stamp = np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+        self.cache_file = None
+        if cache_dir:
+            path_hash = hashlib.sha1(
+                gob_key(gob_file).encode('utf-8')
+                ).hexdigest()[:16]
+            self.cache_file = os.path.join(
+                cache_dir, "gob_toc", path_hash + ".npz"
+                )
+        self.data = None
+        self.view = None
+        if use_mmap:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.view = memoryview(self.data)
         f.close()
-        self.toc = {}
-        self.path_toc = {}
+        self._entries = None
+        self._keys = None
+        self._order = None
+        self._toc = None
+        self._path_toc = None
         self.jkls = []
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        '''releases the archive mapping. Views returned by ungob() keep
+        a mapped archive open until they are released themselves'''
+        self._entries = None
+        if self.view is not None:
+            self.view.release()
+            try:
+                self.data.close()
+            except BufferError:
+                # extracted files still reference the mapping,
+                # it is unmapped once the last of them is gone
+                pass
+
     def set_toc(self):
-        '''sets toc dict. key = filename, value = tuple
-        (file offset from gob start, file length)'''
-        first_size_offset, first_offset, file_count, offset, length = unpack(
-            'LLLLL',
-            self.data[4:24]
-            )
+        '''reads the archive directory once in a single np.frombuffer call.
+        Entries stay in a structured array, file names are only decoded to
+        python strings for the files that are actually looked up'''
+        if self.load_toc_cache():
+            return
 
-        i = 0
-        toc = {}
-        while i < file_count:
-            byte_offset = 24+i*136
-            file_path = unpack('<128s', self.data[byte_offset:byte_offset+128])
-            file_offset, length = unpack(
-                'LL',
-                self.data[byte_offset-8:byte_offset]
-                )
-            file_path_decode = file_path[0].decode('ISO-8859-1')  # bin to str
-            file_path = file_path_decode.split('\x00', 1)[0]  # removed \x00
-            file_name_clean = file_path.split('\\', 2)[-1]
-            toc[file_name_clean] = (file_offset, length)
-            i += 1
-
-        self.toc = toc
-
-    def set_paths_toc(self):
-        first_size_offset, first_offset, file_count, offset, length = unpack(
-            'LLLLL',
-            self.data[4:24]
+        dir_offset, = unpack_from('<L', self.read(8, 4))
+        file_count, = unpack_from('<L', self.read(dir_offset, 4))
+
+        entries = np.frombuffer(
+            self.read(dir_offset + 4, file_count * GOB_ENTRY.itemsize),
+            dtype=GOB_ENTRY,
+            count=file_count
             )
+        self.set_entries(entries, *toc_keys(entries))
+        self.save_toc_cache()
 
-        i = 0
-        path_toc = {}
-        while i < file_count:
-            byte_offset = 24+i*136
-            file_path = unpack('<128s', self.data[byte_offset:byte_offset+128])
-            file_offset, length = unpack(
-                'LL',
-                self.data[byte_offset-8:byte_offset]
-                )
-            file_path_decode = file_path[0].decode('ISO-8859-1')  # bin to str
-            file_path = file_path_decode.split('\x00', 1)[0]  # removed \x00
-            path_toc[file_path] = (file_offset, length)
-            i += 1
+    def load_toc_cache(self):
+        '''sets the toc from the sidecar cache file, if there is one for
+        the current size and mtime of the archive'''
+        if self.cache_file is None or not os.path.isfile(self.cache_file):
+            return False
+        try:
+            with np.load(self.cache_file, allow_pickle=False) as cache:
+                if not np.array_equal(cache['stamp'], self.stamp):
+                    return False
+                self.set_entries(cache['entries'], cache['keys'], cache['order'])
+        except Exception:
+            # truncated or corrupt cache (BadZipFile, EOFError, ...),
+            # the toc is parsed from the archive and the cache rewritten
+            return False
+        return True
 
-        self.path_toc = path_toc
+    def save_toc_cache(self):
+        '''writes the toc arrays to the sidecar cache file, to a temporary
+        file first, so readers never see half a file'''
+        if self.cache_file is None:
+            return
+        temp_file = self.cache_file + ".%d.tmp" % os.getpid()
+        try:
+            os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+            with open(temp_file, 'wb') as f:
+                np.savez(
+                    f,
+                    stamp=self.stamp,
+                    entries=self._entries,
+                    keys=self._keys,
+                    order=self._order
+                    )
+            os.replace(temp_file, self.cache_file)
+        except OSError:
+            print("couldn't write toc cache " + self.cache_file)
 
-    def ungob(self, file):
-        '''takes string of file in GOB/GOO ("00tabl.3do"),
-        returns extracted file'''
-        self.set_toc()
-        file_offset, length = self.toc[file]
-        file_ungob = self.data[file_offset:file_offset+length]
+    def set_entries(self, entries, keys, order):
+        '''sets the directory arrays: entries in archive order, lookup keys
+        (lower case file names) sorted ascending and their entry indices'''
+        self._entries = entries
+        self._keys = keys
+        self._order = order
+        self._toc = None
+        self._path_toc = None
+
+    @property
+    def toc(self):
+        '''dict of file name -> (file offset from gob start, file length)'''
+        if self._toc is None:
+            paths = self.path_toc
+            self._toc = {
+                path.split('\\')[-1]: entry for path, entry in paths.items()
+                }
+        return self._toc
+
+    @property
+    def path_toc(self):
+        '''dict of full file path -> (file offset, file length)'''
+        if self._path_toc is None:
+            if self._entries is None:
+                self.set_toc()
+            entries = self._entries
+            self._path_toc = {
+                name.split(b'\x00', 1)[0].decode('ISO-8859-1'): (offset, length)
+                for name, offset, length in zip(
+                    entries['name'].tolist(),
+                    entries['offset'].tolist(),
+                    entries['length'].tolist()
+                    )
+                }
+        return self._path_toc
+
+    def find(self, file):
+        '''returns (file offset, file length) of a file name,
+        matched case-insensitively, or None if it is not in the archive'''
+        if self._entries is None:
+            self.set_toc()
+        key = file.encode('ISO-8859-1').lower()
+        # last match wins, like a dict filled in archive order
+        i = np.searchsorted(self._keys, key, side='right') - 1
+        if i < 0 or self._keys[i] != key:
+            return None
+        entry = self._entries[self._order[i]]
+        return int(entry['offset']), int(entry['length'])
 
-        return file_ungob
+    def __contains__(self, file):
+        return self.find(file) is not None
+
+    def read(self, offset, length):
+        '''returns length bytes at offset of the archive as a read-only
+        memoryview, a slice of the mapping (no copy) or read from the file.
+        Raises OSError if the archive changed since it was opened'''
+        if self.view is not None:
+            return self.view[offset:offset+length]
+        with open(self.gob_file, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            if stat.st_size != self.stamp[0] or stat.st_mtime_ns != self.stamp[1]:
+                raise OSError("archive changed since it was opened: " + self.gob_file)
+            f.seek(offset)
+            return memoryview(f.read(length))
+
+    def ungob(self, file):
+        '''takes string of file in GOB/GOO ("00tabl.3do", any case),
+        returns extracted file as a read-only memoryview
+        (usable with np.frombuffer, struct.unpack and str())'''
+        entry = self.find(file)
+        if entry is None:
+            raise KeyError(file)
+        file_offset, length = entry
+        return self.read(file_offset, length)
 
     def get_gobed_files(self):
-        '''returns a list of files names'''
-        self.set_toc()
+        '''returns a dict of file names'''
         return self.toc
 
     def get_gobed_paths(self):
-
-        self.set_paths_toc()
+        '''returns a dict of full file paths'''
         return self.path_toc
+
+
+# archives stay registered for the blender session, the least recently used
+# one is closed when more than MAX_OPEN_GOBS are registered. Only the game's
+# resource archives are memory-mapped (use_mmap): windows locks a mapped file
+# against being overwritten, a level or mod archive that is being rebuilt
+# is read on demand instead (directory and extracted files only), it is
+# only open during a read and never kept in memory as a whole
+
+MAX_OPEN_GOBS = 8
+
+open_gobs = OrderedDict()   # normalized path -> (mtime, Gob)
+
+
+def gob_key(gob_file):
+    return os.path.normcase(os.path.abspath(str(gob_file)))
+
+
+def open_gob(gob_file, cache_dir=None, use_mmap=False):
+    '''returns the shared Gob of an archive, opened and its toc parsed
+    only once per session. A changed mtime reopens the archive.
+    cache_dir and use_mmap are passed on to Gob() when it is opened.
+    Raises FileNotFoundError like Gob()'''
+    path = gob_key(gob_file)
+    mtime = os.stat(path).st_mtime_ns
+
+    cached = open_gobs.get(path)
+    if cached is not None:
+        if cached[0] == mtime:
+            open_gobs.move_to_end(path)
+            return cached[1]
+        invalidate_gob(path)
+
+    gob = Gob(path, use_mmap=use_mmap, cache_dir=cache_dir)
+    open_gobs[path] = (mtime, gob)
+
+    while len(open_gobs) > MAX_OPEN_GOBS:
+        # files already extracted from it stay valid, see Gob.close()
+        open_gobs.popitem(last=False)[1][1].close()
+
+    return gob
+
+
+def invalidate_gob(gob_file):
+    '''closes an archive and removes it from the registry'''
+    cached = open_gobs.pop(gob_key(gob_file), None)
+    if cached is not None:
+        cached[1].close()
+
+
+def close_gobs():
+    '''closes all registered archives'''
+    while open_gobs:
+        open_gobs.popitem()[1][1].close()
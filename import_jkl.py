@@ -1,18 +1,29 @@
-import re
+import mmap
 import bpy
+import numpy as np
 import pathlib
 from os.path import basename, dirname
 from .import_3do import Thing
 from .import_mat import Mat
-from .import_gob import Gob
+from .import_cmp import shared_colormap
+from .jk_vfs import Vfs, JK_RESOURCE_GOBS, MOTS_RESOURCE_GOBS
 from . import jk_parse
+from . import jk_mesh
+from . import jk_light
+from . import jk_pvs
+from . import jk_image
 
 
 class Level:
 
-    def __init__(self, path, importThings, importMats, importIntensities, importEmission, importAlpha, scale, select_shader, import_sector_info, source):
-        '''initialize jkl with diverse import flags'''
-        self.lines = None
+    def __init__(self, path, importThings, importMats, importIntensities, importEmission, importAlpha, scale, select_shader, import_sector_info, source, gob_file=None, split_sectors=False, cull_adjoins=False, pvs_depth=0, cluster_size=1):
+        '''initialize jkl with diverse import flags,
+        gob_file is the archive the jkl was taken from,
+        split_sectors imports one object per sector, or per cluster of
+        up to cluster_size adjacent sectors, and their visible sets up
+        to pvs_depth adjoins (0 = unlimited, a limit is approximate),
+        cull_adjoins drops adjoin surfaces that aren't drawn'''
+        self.data = None
         self.importThings = importThings
         self.importMats = importMats
         self.importIntensities = importIntensities
@@ -24,29 +35,33 @@ class Level:
         self.path = path
         self.name = ""
         self.source = source
+        self.gob_file = gob_file
+        self.split_sectors = split_sectors
+        self.cull_adjoins = cull_adjoins
+        self.pvs_depth = pvs_depth
+        self.cluster_size = cluster_size
 
 
     def open_jkl(self, jkl_file):
-        f = open(jkl_file, 'r')
-        self.lines=f.readlines()  # store the entire file in a variable
-        f.close()
+        '''memory-maps a loose jkl file, sections are decoded on demand'''
+        with open(jkl_file, 'rb') as f:
+            try:
+                self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # empty file, can't be mapped
+                self.data = f.read()
 
 
     def open_from_gob(self, ungobed_file):
-        ungobed_string = ungobed_file.decode("ISO-8859-1")
-        self.lines = re.split('\n', ungobed_string)
-        del ungobed_string
+        '''uses the jkl bytes extracted from a gob (memoryview) as they are'''
+        self.data = ungobed_file
 
 
     def import_Level(self):
         '''reads jkl, constructs 3d level mesh, fills with 3do objects and applies materials'''
 
-        lines = self.lines
-
-        levelpath = re.split("\\\\", self.path)
-        name = levelpath[-1].replace(".jkl", "")
-
         path = pathlib.Path(self.path)
+        name = path.name.replace(".jkl", "")
         gob_path = pathlib.Path('')
 
         this_addon = basename(dirname(__file__))
@@ -89,162 +104,59 @@ class Level:
                     motsflag = True
             parent += 1
 
-        # # variable_section = [line position, variable count]
-
-        materials_section = [0, 0]
-        colormaps_section = [0, 0]
-        vertices_section = [0, 0]
-        uvs_section = [0, 0]
-        adjoins_section = [0, 0]
-        surfaces_section = [0, 0]
-        sectors_section = [0, 0]
-        models_section = [0, 0]
-        templates_section = [0, 0]
-        things_section = [0, 0]
-
-        for pos, line in enumerate(lines):
-            match_materials_section = jk_parse.WORLD_MATERIALS_RE.search(line)
-            match_colormaps_section = jk_parse.WORLD_COLORMAPS_RE.search(line)
-            match_vertices_section = jk_parse.WORLD_VERTICES_RE.search(line)
-            match_uvs_section = jk_parse.WORLD_UVS_RE.search(line)
-            match_adjoins_section = jk_parse.WORLD_ADJOINS_RE.search(line)
-            match_surfaces_section = jk_parse.WORLD_SURFACES_RE.search(line)
-            match_sectors_section = jk_parse.WORLD_SECTORS_RE.search(line)
-            match_models_section = jk_parse.WORLD_MODELS_RE.search(line)
-            match_templates_section = jk_parse.WORLD_TEMPLATES_RE.search(line)
-            match_things_section = jk_parse.WORLD_THINGS_RE.search(line)
-            if match_materials_section:
-                materials_section = [pos+1 , int(match_materials_section.group(1))]
-            elif match_colormaps_section:
-                colormaps_section = [pos+1 , int(match_colormaps_section.group(1))]
-            elif match_vertices_section:
-                vertices_section = [pos+1 , int(match_vertices_section.group(1))]
-            elif match_uvs_section:
-                uvs_section = [pos+1 , int(match_uvs_section.group(1))]
-            elif match_adjoins_section:
-                adjoins_section = [pos+1 , int(match_adjoins_section.group(1))]
-            elif match_surfaces_section:
-                surfaces_section = [pos+1 , int(match_surfaces_section.group(1))]
-            elif match_sectors_section:
-                sectors_section = [pos+1 , int(match_sectors_section.group(1))]
-            elif match_models_section:
-                models_section = [pos+1 , int(match_models_section.group(1))]
-            elif match_templates_section:
-                templates_section = [pos+1 , int(match_templates_section.group(1))]
-            elif match_things_section:
-                things_section = [pos+1 , int(match_things_section.group(1))]
-                break
+        # index of all sections, byte ranges in the raw jkl
 
+        sections = jk_parse.index_sections(self.data)
 
-        # read in vertices ###############################################
+        def section(header):
+            '''decoded lines of a section, only read when needed'''
+            return jk_parse.section_text(self.data, sections, header)
 
-        vert_array = []  # 2D array with vertices x, y, z
+        def section_bytes(header):
+            '''raw bytes of a numeric section, parsed without decoding'''
+            return jk_parse.section_bytes(self.data, sections, header)
 
-        i=0
-        while i < vertices_section[1]:
-            i+=1
-            vert_line=re.split("\s+", lines[i + vertices_section[0]], 4)
-            del vert_line[0]
-            del vert_line[3]
-            vert_line[0]=float(vert_line[0]) * self.scale
-            vert_line[1]=float(vert_line[1]) * self.scale
-            vert_line[2]=float(vert_line[2]) * self.scale
-            vert_array.append(vert_line)
+        def count(header):
+            '''count of a World section'''
+            return jk_parse.section_count(sections, header)
 
-        # read in uvs #####################################################
-
-        uv_array = []
-        i=0
-        while i < uvs_section[1]:
-            i += 1
-            uv_line = re.split("\s+", lines[i + uvs_section[0]])
-            del uv_line[0]
-            del uv_line[-1]
-            uv_line[0] = float(uv_line[0])
-            uv_line[1] = float(uv_line[1])
-            uv_array.append(uv_line)
-
-
-        # read in sectors #################################################
 
-        sector_pos = []
-        sectors_pos_array = []
-        # [[NUM, STARTPOS, ENDPOS], [NUM, STARTPOS, ENDPOS]...]
-
-        i = 0
-        while i < sectors_section[1]:
-            sector_line_count = 0
-            sectors_dict = {}
-            for line in lines[sectors_section[0]:models_section[0]]:
-                match_sector = jk_parse.SECTOR_RE.search(line)
-                match_ambient = jk_parse.SECTOR_AMBIENT_RE.search(line)
-                match_extra = jk_parse.SECTOR_EXTRA_RE.search(line)
-                match_tint = jk_parse.SECTOR_TINT_RE.search(line)
-                match_boundbox = jk_parse.SECTOR_BOUNDBOX_RE.search(line)
-                match_center = jk_parse.SECTOR_CENTER_RE.search(line)
-                match_radius = jk_parse.SECTOR_RADIUS_RE.search(line)
-                match_surfaces = jk_parse.SECTOR_SURFACES_RE.search(line)
-                sector_line_count += 1
-
-                if match_sector:
-                    sectors_dict = {'sector':int(match_sector.group(1))}
-                    sectors_dict['start'] = sectors_section[0] + sector_line_count
-
-                elif match_ambient:
-                    sectors_dict['ambient'] = float(match_ambient.group(1))
-
-                elif match_extra:
-                    sectors_dict['extra'] = float(match_extra.group(1))
-
-                elif match_tint:
-                    sectors_dict['tint'] = [float(match_tint.group(1)), float(match_tint.group(2)), float(match_tint.group(3))]
-
-                elif match_boundbox:
-                    sectors_dict['boundbox'] = [float(match_boundbox.group(1)), float(match_boundbox.group(2)), float(match_boundbox.group(3)), float(match_boundbox.group(4)), float(match_boundbox.group(5)), float(match_boundbox.group(6))]
+        # read in vertices ###############################################
 
-                elif match_center:
-                    sectors_dict['center'] = [float(match_center.group(1)), float(match_center.group(2)), float(match_center.group(3))]
+        vert_array = jk_parse.parse_rows(
+            section_bytes("World vertices"),
+            count("World vertices"),
+            3
+            )                                           # (N, 3) x, y, z
+        vert_array *= self.scale
 
-                elif match_radius:
-                    sectors_dict['radius'] = [float(match_radius.group(1))]
+        # read in uvs #####################################################
 
-                elif match_surfaces:
-                    sectors_dict['end'] = sectors_section[0] + sector_line_count
-                    sectors_dict['surfaces'] = int(match_surfaces.group(1)) + int(match_surfaces.group(2)) -1 # last surface in this sector
+        uv_array = jk_parse.parse_rows(
+            section_bytes("World texture vertices"),
+            count("World texture vertices"),
+            2
+            )                                           # (N, 2) u, v
 
-                    i += 1
-                # if sectors_dict:
-                    sectors_pos_array.append(sectors_dict)
-            del sectors_dict
 
-        def get_surface_index(surf):
-            return surf.get('surfaces')
+        # read in sectors #################################################
 
-        sectors_pos_array.sort(key=get_surface_index)
+        sectors = jk_parse.Sectors(
+            section("World sectors"),
+            count("World sectors")
+            )
 
 
         # read in surfaces ################################################
 
-        surf_list = []                                      # world VERTICES
-        surf_vertices = []
-
-        surf_intensities = []
-        surf_intensities_list = []
-
-        uv_indices = []
-        uv_index_list = []
-        material_indices = []
+        surfaces = jk_parse.Surfaces(
+            section_bytes("World surfaces"),
+            count("World surfaces"),
+            motsflag
+            )
 
-        alpha_mats_ids = []
         alpha_mats = {}
 
-        sector_extralight = 0.0
-        sector_ambient = 0.0
-        sector_tint = [0.0, 0.0, 0.0]
-
-        current_sector = 0
-
-
         if self.import_sector_info:
             # create sector property objects
             sector_collection = bpy.data.collections.new('Sectors')
@@ -255,113 +167,60 @@ class Level:
             sector_collection.children.link(sector_num_coll)
             sector_collection.children.link(sector_radius_coll)
             sector_collection.children.link(sector_bbox_coll)
-            for prop in sectors_pos_array:
+            for sector in range(len(sectors)):
                 # boundboxes
-                (x1, y1, z1, x2, y2, z2) = prop['boundbox']
-                (x1, y1, z1, x2, y2, z2) = (x1*self.scale, y1*self.scale, z1*self.scale, x2*self.scale, y2*self.scale, z2*self.scale)
+                (x1, y1, z1, x2, y2, z2) = sectors.boundbox[sector] * self.scale
                 bb_verts = ((x1, y1, z1), (x1, y2, z1), (x1, y2, z2), (x1, y1, z2), (x2, y1, z1), (x2, y2, z1), (x2, y2, z2), (x2, y1, z2))
                 bb_faces = ((0, 1, 2, 3), (1, 5, 6, 2), (5, 4, 7, 6), (4, 0, 3, 7), (3, 2, 6, 7), (0, 4, 5, 1))
-                boundbox_empty = bpy.data.meshes.new('boundbox_'+str(prop['sector'])+'Mesh')
-                bbox_ob = bpy.data.objects.new('boundbox_'+str(prop['sector']), boundbox_empty)
+                boundbox_empty = bpy.data.meshes.new('boundbox_'+str(sector)+'Mesh')
+                bbox_ob = bpy.data.objects.new('boundbox_'+str(sector), boundbox_empty)
                 bbox_ob.display_type = 'WIRE'
                 boundbox_empty.from_pydata(bb_verts, [], bb_faces)
                 boundbox_empty.update()
                 # sectors
-                sector_empty = bpy.data.objects.new("sector_" + str(prop['sector']), None)
-                sector_radius = bpy.data.objects.new("radius_" + str(prop['sector']), None)
+                sector_empty = bpy.data.objects.new("sector_" + str(sector), None)
+                sector_radius = bpy.data.objects.new("radius_" + str(sector), None)
                 sector_radius.empty_display_type = 'SPHERE'
-                sector_radius.empty_display_size = prop['radius'][0]*self.scale
-                bpy.data.collections['Index'].objects.link(sector_empty)
-                bpy.data.collections['Radius'].objects.link(sector_radius)
-                bpy.data.collections['Boundbox'].objects.link(bbox_ob)
-                sector_x, sector_y, sector_z = prop['center'][0]*self.scale, prop['center'][1]*self.scale, prop['center'][2]*self.scale
+                sector_radius.empty_display_size = sectors.radius[sector]*self.scale
+                sector_num_coll.objects.link(sector_empty)
+                sector_radius_coll.objects.link(sector_radius)
+                sector_bbox_coll.objects.link(bbox_ob)
+                sector_x, sector_y, sector_z = sectors.center[sector] * self.scale
                 sector_empty.location = sector_x, sector_y, sector_z
                 sector_radius.location = sector_x, sector_y, sector_z
                 sector_empty.show_name = True
 
 
-        i=0
-        while i < surfaces_section[1]:
-            surfLine=re.split("\s+", lines[i + surfaces_section[0] + 1],)
-            matId = int(surfLine[1])
-            surfflag = int(surfLine[2], base=16)
-            faceflag = int(surfLine[3], base=16)
-            geomode = int(surfLine[4])                        # 0 = don't draw, 4 = textured (else)
-            light = int(surfLine[5])
-            tex = int(surfLine[6])
-            adjoin = int(surfLine[7])
-            extralight = float(surfLine[8])
-            nvert=int(surfLine[9])                          # count of vertexes needed for surfaces (nverts)
-
-            # if adjoin + material, then probably transparent!
-
-            material_indices.append(matId)
-
-            if adjoin > -1 and matId > -1:
-                alpha_mats_ids.append(matId)
-                alpha_mats_ids = sorted(set(alpha_mats_ids))
+        # face flags of the last surface, passed on to the materials
+        faceflag = int(surfaces.faceflags[-1]) if len(surfaces) else 0
 
-            j = 0
+        # if adjoin + material, then probably transparent!
+        alpha_mats_ids = np.unique(surfaces.material[(surfaces.adjoin > -1) & (surfaces.material > -1)])
 
-            while j < nvert:
-                v_index  = re.split(",",surfLine[j+10])
-                surf_vertices.append(int(v_index[0]))
-                uv_index_list.append(int(v_index[1]))
-                j+=1
-            surf_list.append(surf_vertices)
-            uv_indices.append(uv_index_list)
+        # sector of every surface, -1 = none
+        face_sector = sectors.surface_sector(len(surfaces))
 
+        # read in adjoins, sector connectivity graph ########################
 
-            # get sector light intensities per surface from sector list
-            if i >= sectors_pos_array[current_sector]['surfaces']:
-                sector_extralight = sectors_pos_array[current_sector]['extra']
-                sector_ambient = sectors_pos_array[current_sector]['ambient']
-                sector_tint = sectors_pos_array[current_sector]['tint']
-                current_sector += 1
-
-
-            j = 0
-            if motsflag:                   #  color light intensities in Mots (intensity, r, g, b)
-                while j < nvert*4:
-                    surf_intensities.append(float(surfLine[10+nvert+j]) + extralight + sector_extralight)
-                    j+=1
-            else:
-                while j < nvert:
-                    intensity = float(surfLine[10+nvert+j])
-                    r = intensity + extralight + sector_extralight # * sector_tint[0]
-                    g = intensity + extralight + sector_extralight # * sector_tint[1]
-                    b = intensity + extralight + sector_extralight # * sector_tint[2]
-                    surf_intensities.append((r, g, b))
-                    j+=1
-            surf_intensities_list.append(surf_intensities)
-
-
-            surf_vertices = []
-            uv_index_list = []
-            surf_intensities = []
-            i+=1
+        adjoins = jk_parse.Adjoins(
+            section_bytes("World adjoins"),
+            count("World adjoins")
+            )
+        adjoin_indptr, adjoin_sectors, adjoin_edges = adjoins.sector_graph(
+            surfaces.adjoin, face_sector, len(sectors)
+            )
 
 
         # read in materials ################################################
-        # TODO find better ways to terminate at end of material list
 
-        mat_line = ""
         mat_list = []
         mat_tiling_list = []
-        for i in range(1, 1000): # only allows for 1000 mat files
-            mat_line = lines[i + materials_section[0] + (1 if not motsflag else 0)]
-            if re.match(r'(#|//).*', mat_line) or len(mat_line) < 3:
-                # skip comment lines and empty lines
-                continue
-            mat_line = re.split("\s+", mat_line)
-            mat_list.append(mat_line[1].lower())
-            if mat_line[0] != "end":
-                mat_tiling_tuple = (float(mat_line[2]), float(mat_line[3]))
-                mat_tiling_list.append(mat_tiling_tuple)
+        for row in jk_parse.parse_list(section("World materials"), count("World materials")):
+            mat_list.append(row[0].lower())
+            if len(row) > 2:
+                mat_tiling_list.append((float(row[1]), float(row[2])))
             else:
-                break
-            if mat_line[0] == "end":
-                break
+                mat_tiling_list.append((1.0, 1.0))
 
 
         # get a material name list, for object application
@@ -372,7 +231,8 @@ class Level:
             mat_name_list.append(material_name)
 
         level_materials = []                                # list for select level geo material names
-        material_list = sorted(set(material_indices))       # level mat indices, removed duplicates and sorted in ascending order
+        material_list = np.unique(surfaces.material)        # level mat indices, removed duplicates and sorted in ascending order
+        material_list = material_list[material_list > -1]
         for position in material_list:
             level_materials.append(mat_name_list[int(position)])
         for position in alpha_mats_ids:
@@ -394,27 +254,28 @@ class Level:
             mat.node_tree.links.new(output.inputs['Surface'], transpNode.outputs['BSDF'])
             mat.blend_method = 'CLIP'
 
-        placeholder_mat('__portal', None)      # transparent bsdf
+        if '__portal' not in bpy.data.materials:
+            placeholder_mat('__portal', None)      # transparent bsdf
 
-        # load GOB, if neccessary ###############################################
+        # build virtual file system, if neccessary ##############################
+        # loose resource files first, then the level's archive and
+        # finally the game's resource archives
 
         if self.importMats or self.importThings:
-            if motsflag:
-                try:
-                    gob = Gob(gob_path.joinpath("JKMRES.GOO"))
-                    print("assigning JKMRES.GOO")
-                except FileNotFoundError:
-                    bpy.ops.report.exception(report_message="JKMRES.GOO")
-                    self.importMats = False
-                    self.importThings = False
-            else:
-                try:
-                    gob = Gob(gob_path.joinpath("Res2.gob"))
-                    print("assigning Res2.gob")
-                except FileNotFoundError:
-                    bpy.ops.report.exception(report_message="Res2.gob")
-                    self.importMats = False
-                    self.importThings = False
+            vfs = Vfs(prefs.temp_folder or None)
+            if gob_path.is_absolute():
+                vfs.add_directory(gob_path)
+            if self.gob_file:
+                vfs.add_gob(self.gob_file)
+            resource_gobs = MOTS_RESOURCE_GOBS if motsflag else JK_RESOURCE_GOBS
+            for resource_gob in resource_gobs:
+                if vfs.add_gob(gob_path.joinpath(resource_gob), use_mmap=True):
+                    print("assigning " + resource_gob)
+            if not gob_path.joinpath(resource_gobs[0]).is_file():
+                bpy.ops.report.exception(report_message=resource_gobs[0])
+            if not vfs.layers:
+                self.importMats = False
+                self.importThings = False
 
 
         # call material loading class ###########################################
@@ -425,12 +286,14 @@ class Level:
 
 
         if self.importMats:
-            cmp_file = re.split("\s+", lines[colormaps_section[0]],)[1]
-            colormap = gob.ungob(cmp_file.lower())
+            cmp_file = jk_parse.parse_list(section("World colormaps"), 1)[0][0]
+            colormap = shared_colormap(vfs.ungob(cmp_file))
             print("colormap:", cmp_file.lower())
-            for material in mat_list:
-                material_loaded = material in bpy.data.materials
-                if material in alpha_mats and self.importAlpha:
+            # blender materials are named without ".mat", those of
+            # earlier imports (batch levels) are reused
+            for material, material_name in zip(mat_list, mat_name_list):
+                material_loaded = material_name in bpy.data.materials
+                if material_name in alpha_mats and self.importAlpha:
                     alpha = True
                     print(material, "has alpha channel")
                 else:
@@ -439,16 +302,20 @@ class Level:
                     print(material, "already loaded")
                 else:
                     try:
-                        mat = Mat(gob.ungob(material), colormap, alpha, material, self.select_shader, self.importEmission, faceflag)
+                        mat = Mat(vfs.ungob(material), colormap, alpha, material, self.select_shader, self.importEmission, faceflag)
                         mat.import_Mat()
                     except:
-                        placeholder_mat(material, (1.0,0.0,1.0,1))
+                        placeholder_mat(material_name, (1.0,0.0,1.0,1))
                         print("couldn't import " + material + ". created placeholder mat")
 
 
         else:
             print("skipped material import")
 
+        # (width, height, x tile, y tile) of every jkl material, [-1] for
+        # faces without material. Tiling is kept, but not applied to uvs.
+        textures = jk_mesh.texture_table(mat_name_list, mat_tiling_list)
+
 
         # test material append from other blend file ##########################
 
@@ -463,41 +330,35 @@ class Level:
         if self.importThings:
 
             # read in templates ################################################
-            #   TODO: MotS re                                                  #
+
+            templates = jk_parse.Templates(
+                section("World templates")
+                )
+
+            # read in things ###################################################
             #   x, y, z, pitch, yaw and roll can also be single digits (0)     #
             #   instead of a number noted as float (0.0000000)
 
-            #                          num   template  name      x              y             z             pitch         yaw           roll         sector            thingflag
             things_list = []
-            thingsEx = re.compile("(\d+)\:\s(\S+)\s+(\S+)\s+(-?\d*\.?\d*)\s+(-?\d*\.?\d*)\s+(-?\d*\.?\d*)\s+(-?\d*\.?\d*)\s+(-?\d*\.?\d*)\s+(-?\d*\.?\d*)\s+(\d+)")
-            for line in lines[things_section[0]+1:things_section[0]+things_section[1]+3]:
-                match = thingsEx.search(line)
-                if match:
-                    thingtransforms = []
-                    num = match.group(1)
-                    template =  match.group(2)
-                    tempName = match.group(3)
-                    templateEx = re.compile("^" + tempName + "\s+\w+\s+.*?model3d=(\S+\.3do).*$")     ####   ^.*\b(one|two|three)\b.*$
-                    for line in lines[templates_section[0]+1:templates_section[0]+templates_section[1]+3]:                                            ####
-                        found = templateEx.search(line)                           ####    experimental
-                        if found:                                                 ####
-                            tempName = found.group(1)                             ####
-                    thingtransforms.append(tempName)
-                    thingX = match.group(4)
-                    thingtransforms.append(thingX)
-                    thingY = match.group(5)
-                    thingtransforms.append(thingY)
-                    thingZ = match.group(6)
-                    thingtransforms.append(thingZ)
-                    thingPitch = match.group(7)
-                    thingtransforms.append(thingPitch)
-                    thingYaw = match.group(8)
-                    thingtransforms.append(thingYaw)
-                    thingRoll = match.group(9)
-                    thingtransforms.append(thingRoll)
-                    Sector = match.group(10)
-                    things_list.append(thingtransforms)
-                    del thingtransforms
+            things_block = section("World things")
+            for match in jk_parse.THING_RE.finditer(things_block):
+                template = match.group(2)
+                if template not in templates:
+                    template = match.group(3)
+                # the thing's own params override the template ones
+                params = jk_parse.parse_params(match.group(11).split())
+                model = params.get("model3d", templates.get(template, "model3d"))
+                if model is None:
+                    model = match.group(3)
+                things_list.append([
+                    model,
+                    match.group(4),     # x
+                    match.group(5),     # y
+                    match.group(6),     # z
+                    match.group(7),     # pitch
+                    match.group(8),     # yaw
+                    match.group(9)      # roll
+                    ])
 
             copy_flag = True
 
@@ -505,7 +366,7 @@ class Level:
             for mesh in things_list:
                 mesh_name = mesh[0].replace(".3do", "")
                 try:
-                    ungobed_file = gob.ungob(mesh[0])
+                    ungobed_file = vfs.ungob(mesh[0])
                     if copy_flag:
                         thing = Thing(ungobed_file, float(mesh[1]),float(mesh[2]),float(mesh[3]), float(mesh[4]), float(mesh[5]), float(mesh[6]), self.scale, mesh_name, motsflag, False)
                         if mesh[0] in things_names:
@@ -527,96 +388,140 @@ class Level:
 
         # create the mesh ##################################################
 
-        def create_Level(verts, faces):
+        # Level material slots, lookup array jkl material index -> slot,
+        # faces without material (-1) -> portal slot at the end. Every mesh
+        # only gets the slots its faces use
+        slot_materials = []
+        slot_of_material = np.zeros(len(mat_name_list) + 1, dtype=np.int32)
+        missing_slot = None
+        for position, material in zip(material_list, level_materials):
+            if material in bpy.data.materials:
+                slot_of_material[position] = len(slot_materials)
+                slot_materials.append(bpy.data.materials[material])
+            else:
+                print("couldn't append " + material + " to mesh")
+                if missing_slot is None:                                    # one empty slot for all missing materials
+                    missing_slot = len(slot_materials)
+                    slot_materials.append(None)
+                slot_of_material[position] = missing_slot
+
+        slot_of_material[-1] = len(slot_materials)
+        slot_materials.append(bpy.data.materials['__portal'])                # portal material at [-1] in material_index
+
+        def create_Level(name, verts, surfaces):
+            '''creates a mesh object of surfaces (all or a selection of the
+            world surfaces), the object isn't linked to a collection yet'''
             # Create mesh and object
             me = bpy.data.meshes.new(name+'Mesh')
             ob = bpy.data.objects.new(name, me)
-            ob.show_name = True
 
-            # Add materials to meshes
-            for material in level_materials:
-                try:
-                    mat = bpy.data.materials[material]
-                    ob.data.materials.append(mat)
-                except:
-                    print("couldn't append " + material + " to mesh")
+            # only the slots its faces use, renumbered for this mesh
+            used_slots, material_index = np.unique(
+                slot_of_material[surfaces.material], return_inverse=True
+                )
+            for slot in used_slots:
+                me.materials.append(slot_materials[slot])
 
-            ob.data.materials.append(bpy.data.materials['__portal'])            # portal material at [-1] in material_index
-
-            # Link object to scene
-            scene = bpy.context.scene
-            scene.collection.objects.link(ob)
-            me.from_pydata(verts, [], faces)
+            jk_mesh.build_mesh(me, verts, surfaces.loop_start, surfaces.loop_total, surfaces.vertex_indices)
             # me.validate()         # should be validated, currently UV index out of range error
 
-            # add uv map
-            me.uv_layers.new(name='UVMap')
-            uvMap = me.uv_layers['UVMap']
-
-            # add vertex color layer
-            vcol = me.vertex_colors.new(name='Intensities')
-
             # assign every needed material to faces
-            for isrf, surface in enumerate(surf_list):
-                polygon = me.polygons[isrf]                                     # assign face from 'world surfaces' list
-
-                texture_size = (16, 16)
-                tiling = (1.0, 1.0)
-
-                if material_indices[isrf] != -1:                                # material numbers from world surfaces (188, 189, 190, -1)
-                    material_name = mat_name_list[(material_indices[isrf])]     # 189 -> '07fst1a' (specific material name)
-                    for index, material in enumerate(me.materials):             #
-                        if material_name in bpy.data.materials:                 # check if material exists
-                            if material.name == material_name:
-                                polygon.material_index = index
-                        else:
-                            polygon.material_index = len(me.materials)
-
-                    if material_name in bpy.data.images:
-                        if bpy.data.images[material_name].size[0] != 0:
-                            texture_size = bpy.data.images[material_name].size
-
-                else:
-                    polygon.material_index = len(me.materials)-1                           # apply last material in material_index (__portal) to portals
-
-                tiling=mat_tiling_list[material_indices[isrf]]
-
-
-                for jsrf, loop in enumerate(uv_indices[isrf]):
-                    u = float(uv_array[uv_indices[isrf][jsrf]][0])/texture_size[0]
-                    v = float(uv_array[uv_indices[isrf][jsrf]][1])/-texture_size[1]
-                    x_tile = tiling[0]                                                  # what's that for? multiplication for size? addition for translation?
-                    y_tile = tiling[1]
-                    uvMap.data[polygon.loop_indices[jsrf]].uv = (u, v)
-
-                    if self.importIntensities:
-                        color=()
-                        if motsflag:
-                            r = surf_intensities_list[isrf][jsrf*4+1]
-                            g = surf_intensities_list[isrf][jsrf*4+2]
-                            b = surf_intensities_list[isrf][jsrf*4+3]
-                            color = (r, g, b, 1.0)
-                        else:
-                            surf_light = surf_intensities_list[isrf][jsrf]
-                            r = surf_light[0]
-                            g = surf_light[1]
-                            b = surf_light[2]
-                            color = (r, g, b, 1.0)
-                        vcol.data[polygon.loop_indices[jsrf]].color = color
-
-
-            #  #Delete Adjoin surfaces
-            # if self.importMats:
-            #     for port_surface in surf_list:
-            #         print(port_surface)
-            #     pass
+            me.polygons.foreach_set("material_index", material_index.astype(np.int32))
+
+            # add uv map, uvs in texels / texture size of the face material
+            uvs = jk_mesh.loop_uvs(
+                uv_array,
+                surfaces.uv_indices,
+                surfaces.material[surfaces.loop_face],
+                textures
+                )
+            jk_mesh.set_uvs(me, uvs, 'UVMap')
+
+            # add vertex color layer (white, if intensities aren't imported)
+            if self.importIntensities:
+                colors = jk_light.loop_colors(
+                    surfaces.intensities,
+                    surfaces.loop_face,
+                    surfaces.extralight,
+                    face_sector[surfaces.source_face],
+                    sectors.extra
+                    )
+            else:
+                colors = np.ones((len(surfaces.loop_face), 4), dtype=np.float32)
+            jk_mesh.set_colors(me, colors, 'Intensities')
 
 
             # Update mesh with new data
             me.update()
+            return ob
 
         ######################################################################
 
-        create_Level(vert_array, surf_list)
+        # drop adjoin surfaces that are never drawn (geo mode 0 or no material)
+        level_surfaces = surfaces
+        if self.cull_adjoins:
+            hidden = (surfaces.adjoin > -1) & ((surfaces.geo == 0) | (surfaces.material == -1))
+            level_surfaces = surfaces.select(np.flatnonzero(~hidden))
+            print("culled " + str(len(surfaces) - len(level_surfaces)) + " adjoin surfaces")
+
+        scene = bpy.context.scene
+        if self.split_sectors:
+            # one object per sector or cluster of adjacent sectors, sliced
+            # from the world arrays. All objects are linked to a new
+            # collection that joins the scene last, so the depsgraph is
+            # only updated once
+            level_collection = bpy.data.collections.new(name)
+            level_sector = face_sector[level_surfaces.source_face]
+            if self.cluster_size > 1:
+                sector_cluster = jk_pvs.sector_clusters(adjoin_indptr, adjoin_sectors, self.cluster_size)
+                level_group = np.where(level_sector > -1, sector_cluster[level_sector], -1)
+            else:
+                level_group = level_sector
+            order = np.argsort(level_group, kind='stable')
+            group_ids, first = np.unique(level_group[order], return_index=True)
+            for group, faces in zip(group_ids, np.split(order, first[1:])):
+                part = level_surfaces.select(faces)
+                part_verts, part.vertex_indices = jk_mesh.compact_vertices(vert_array, part.vertex_indices)
+                part_sectors = np.unique(level_sector[faces])
+                if group == -1:
+                    part_name = name + "_sector_none"
+                elif len(part_sectors) == 1:
+                    part_name = name + "_sector_" + str(part_sectors[0])
+                else:
+                    part_name = name + "_cluster_" + str(group)
+                ob = create_Level(part_name, part_verts, part)
+                ob["jk_level"] = name
+                ob["jk_sectors"] = part_sectors.tolist()
+                level_collection.objects.link(ob)
+            scene.collection.children.link(level_collection)
+        else:
+            ob = create_Level(name, vert_array, level_surfaces)
+            ob.show_name = True
+            # Link object to scene
+            scene.collection.objects.link(ob)
+
+        # sector graph on the scene, scene["jk_levels"][level name]
+        level = {
+            "sector_count": len(sectors),
+            "adjoin_indptr": adjoin_indptr.tolist(),
+            "adjoin_sectors": adjoin_sectors.tolist(),
+            "adjoin_flags": adjoins.flags[adjoin_edges].tolist(),
+            }
+
+        # potentially visible sets for hiding the sector objects
+        # that can't be seen from the camera
+        if self.split_sectors:
+            portals = jk_pvs.Portals(vert_array, surfaces, face_sector, adjoins)
+            visible = jk_pvs.visible_sets(portals, len(sectors), self.pvs_depth)
+            level["pvs"], level["pvs_width"] = jk_pvs.encode_sets(visible, len(sectors))
+            level["sector_boundbox"] = (sectors.boundbox * self.scale).ravel().tolist()
+
+        if "jk_levels" not in scene:
+            scene["jk_levels"] = {}
+        scene["jk_levels"][name] = level
+
+        # temp folder textures were written in the background, wait for them
+        jk_image.flush_pngs(bpy.data.images)
+        jk_image.trim_texture_cache(prefs.temp_folder)
 
         return {'FINISHED'}
@@ -2,28 +2,67 @@ from struct import unpack
 from . import jk_flags
 import numpy as np
 import bpy
+from . import jk_image
 from pathlib import Path
 from os.path import basename, dirname
 
 
 class Mat:
-    def __init__(self, mat, pal, alpha, name, shader, emission, faceflags):
+    def __init__(self, mat, colormap, alpha, name, shader, emission, faceflags):
         '''
-        initializes a material, takes material file name
-        and palette file name (currently unused)
+        initializes a material, takes material file
+        and the decoded Colormap of its level
         '''
         self.mat = mat
         self.name = name.replace(".mat", "")
-        self.pal = pal
+        self.colormap = colormap
         self.transp = False
         self.alpha = alpha
         self.anim = False
         self.shader = shader
         self.emission = emission
-        self.flags = faceflags
+        self.flags = faceflags or 0
 
     def __str__(self):
-        print(self.mat, self.pal)
+        print(self.mat, self.colormap)
+
+    def read_frames(self, offset, num_textures):
+        '''
+        returns the full size image of every texture (frame) as a strided
+        uint8 view (frames, size_y, size_x) into the mat file. Each frame is
+        a TTextureData header (size x, size y, transparent, 2 * padding,
+        number of mipmaps) followed by its mipmap chain, the smaller mipmaps
+        are skipped. Frames of another size than the first are left out
+        '''
+        data = np.frombuffer(self.mat, dtype=np.uint8)
+        size_x = size_y = frame_len = None
+        starts = []
+        for frame in range(num_textures):
+            x, y, transparent, pad1, pad2, mipmaps = unpack("<LLLLLL", self.mat[offset:offset+24])
+            mipmaps = max(mipmaps, 1)
+            chain_len = sum((x >> level) * (y >> level) for level in range(mipmaps))
+            if size_x is None:
+                size_x, size_y, frame_len = x, y, 24 + chain_len
+            if (x, y) == (size_x, size_y) and offset + 24 + x*y <= len(data):
+                starts.append(offset + 24)
+            else:
+                print(self.name, "frame", frame, "skipped, size", x, "x", y)
+            offset += 24 + chain_len
+
+        if not starts:
+            raise ValueError(self.name + " has no texture data")
+        if len(starts) > 1 and np.all(np.diff(starts) == frame_len):
+            # equally spaced frames: one view with the frame length as stride
+            return np.lib.stride_tricks.as_strided(
+                data[starts[0]:],
+                shape=(len(starts), size_y, size_x),
+                strides=(frame_len, size_x, 1),
+                writeable=False
+                )
+        return np.stack([
+            data[start:start + size_x*size_y].reshape((size_y, size_x))
+            for start in starts
+            ])
 
     def import_Mat(self):
         '''
@@ -33,7 +72,7 @@ class Mat:
 
         # read in header
 
-        t_mat_header = unpack("ccccLLLLLLLLLLLLLLLLLLLLLLLL", self.mat[0:100])
+        t_mat_header = unpack("<ccccLLLLLLLLLLLLLLLLLLLLLLLL", self.mat[0:100])
         ver = t_mat_header[4]
         ttype = t_mat_header[5]
         NumOfTextures = t_mat_header[6]
@@ -59,95 +98,96 @@ class Mat:
 
         if ttype == 2:
 
-            t_tex_header = unpack("LLLLLLLL", self.mat[100:132])
+            t_tex_header = unpack("<LLLLLLLL", self.mat[100:132])
 
             header_offset = TMAT_HEADER_LEN + TTEX_HEADER_LEN * NumOfTextures
 
-            size_x, size_y = unpack("LL", self.mat[header_offset:header_offset+8])
-
-            image = bpy.data.images.new(self.name, width=size_x, height=size_y*NumOfTextures)
-
-            # create numpy pixel data
+            this_addon = basename(dirname(__file__))
+            prefs = bpy.context.preferences.addons[this_addon].preferences
 
-            # matrix shape: frames * length of pixel data incl. header
-            img = np.frombuffer(
+            # decoded images are cached by mat, colormap and decode flags
+            cache_key = jk_image.texture_key(
                 self.mat,
-                dtype=np.uint8,
-                count=(size_y * size_x * NumOfTextures) + (TTEX_DATA_LEN * NumOfTextures),
-                offset=header_offset
-                ).reshape((NumOfTextures, size_x*size_y+TTEX_DATA_LEN))
-
-            # remove TTextureData columns
-            img_del = np.delete(img, np.s_[0:TTEX_DATA_LEN], axis=1)
-
-            # reshape to image dimensions
-            img_headless = img_del.reshape((size_y*NumOfTextures, size_x))
-
-            # flip upside down to blender pixel direction (0,0 = bottom left)
-            img_matrix = np.flipud(img_headless)
-
-            # read in color values to RGB table shape
-            col_pal = np.frombuffer(self.pal, dtype=np.uint8, count=256*3, offset=64).reshape((256, 3)) / 255
-
-            # read in alpha values from last light level table
-            trans_pal = np.frombuffer(self.pal, dtype=np.uint8, count=256, offset=64 + (256*3) + (256*63)).reshape((256, 1)) / 63
+                self.colormap.digest,
+                "alpha=%d emission=%d" % (self.alpha, self.emission)
+                )
+            cached = jk_image.load_textures(prefs.temp_folder, cache_key)
 
-            # concat alpha values to RGB table
-            if self.alpha:
-                pal_rgba = np.hstack((col_pal, trans_pal))
-            else:
-                pal_rgba = np.hstack((col_pal, np.ones((256, 1))))
-
-            # assign rgba values to image
-            col_image = pal_rgba[img_matrix]
-
-            # flatten image matrix to R,G,B,A,R,G,B,A,....
-            pixels = col_image.flatten()
-
-            image.pixels = pixels
-
-            # # emissive map
             has_em_map = False
-            if self.emission:
-                light_levels = np.frombuffer(self.pal, dtype=np.uint8, count=256, offset=64 + (256*3))
-                emission_pal = col_pal[light_levels]
-
-                # check, if emission is all black
-                em_image = emission_pal[img_matrix]
-                em_image_sum = np.sum(em_image)
-                if em_image_sum > 0.0:
-                    print(self.name, "has emission")
-
-                    # add alpha layer to image matrix
-                    alpha_pixels = np.ones((size_y*NumOfTextures, size_x, 1))
-                    em_image_rgba = np.concatenate((em_image, alpha_pixels), axis=2)
-                    em_pixels = em_image_rgba.flatten()
-
+            diffuse_rgba = emission_rgba = None     # uint8 copies for cache and png files
+            if cached is not None:
+                # cache hit, no decoding
+                NumOfTextures = int(cached['frames'])
+                size_x = cached['diffuse'].shape[1]
+                size_y = cached['diffuse'].shape[0] // NumOfTextures
+
+                image = bpy.data.images.new(self.name, width=size_x, height=size_y*NumOfTextures)
+                diffuse_rgba = cached['diffuse']
+                pixels = jk_image.from_uint8(diffuse_rgba)
+                jk_image.set_pixels(image, pixels)
+
+                if 'emission' in cached:
+                    emission_rgba = cached['emission']
                     emission_image = bpy.data.images.new(self.name + "_E", width=size_x, height=size_y*NumOfTextures, alpha=False)
-                    emission_image.pixels = em_pixels
+                    jk_image.set_pixels(emission_image, jk_image.from_uint8(emission_rgba, out=pixels))
                     has_em_map = True
-                else:
-                    has_em_map = False
-            else:
-                pass
-
-            # save image temporarily
 
-            this_addon = basename(dirname(__file__))
-            prefs = bpy.context.preferences.addons[this_addon].preferences
-            temp_path = Path(prefs.temp_folder)
-            if temp_path != "":
+            else:
+                # 8 bit palette indices of every frame, (frames, size_y, size_x)
+                frames = self.read_frames(header_offset, NumOfTextures)
+                NumOfTextures, size_y, size_x = frames.shape
+
+                image = bpy.data.images.new(self.name, width=size_x, height=size_y*NumOfTextures)
+
+                # flip upside down to blender pixel direction (0,0 = bottom left),
+                # the frames stay a view into the mat file
+                img_matrix = frames[::-1, ::-1]
+
+                # rgba table of the colormap, alpha from the last light level
+                pal_rgba = self.colormap.rgba_table(self.alpha)
+
+                # assign rgba values to image, gathered into one float32 buffer
+                pixels = jk_image.pixel_buffer(size_y*NumOfTextures, size_x)
+                frame_pixels = pixels.reshape((NumOfTextures, size_y, size_x, 4))
+                jk_image.gather(pal_rgba, img_matrix, frame_pixels)
+
+                jk_image.set_pixels(image, pixels)
+                if prefs.temp_folder:
+                    diffuse_rgba = jk_image.to_uint8(pixels)
+
+                # # emissive map
+                if self.emission:
+                    # check, if emission is all black (on the palette indices,
+                    # the emission image is only built if it isn't)
+                    lit = self.colormap.emissive[:, :3].any(axis=1)
+                    if lit[img_matrix].any():
+                        print(self.name, "has emission")
+                        jk_image.gather(self.colormap.emissive, img_matrix, frame_pixels)
+
+                        emission_image = bpy.data.images.new(self.name + "_E", width=size_x, height=size_y*NumOfTextures, alpha=False)
+                        jk_image.set_pixels(emission_image, pixels)
+                        has_em_map = True
+                        if prefs.temp_folder:
+                            emission_rgba = jk_image.to_uint8(pixels)
+
+                if prefs.temp_folder:
+                    cache = {'frames': np.array(NumOfTextures), 'diffuse': diffuse_rgba}
+                    if has_em_map:
+                        cache['emission'] = emission_rgba
+                    jk_image.save_textures(prefs.temp_folder, cache_key, **cache)
+
+            # save image temporarily, png files are written in the
+            # background until jk_image.flush_pngs() at the end of the import
+
+            if prefs.temp_folder:
+                temp_path = Path(prefs.temp_folder)
                 joined_path = temp_path.joinpath(self.name + ".png")
                 joined_path_e = temp_path.joinpath(self.name + "_E.png")
-                image.filepath_raw = str(joined_path)
-                image.file_format = 'PNG'
-                image.save()
+                jk_image.write_png_async(image, str(joined_path), diffuse_rgba)
                 if has_em_map:
-                    emission_image.filepath_raw = str(joined_path_e)
-                    emission_image.file_format = 'PNG'
-                    emission_image.save()
+                    jk_image.write_png_async(emission_image, str(joined_path_e), emission_rgba)
             else:
-                self.report({'INFO'}, "Missing temp folder, check add-on preferences!")
+                print("Missing temp folder, check add-on preferences!")
 
             # create material
 
@@ -276,9 +316,7 @@ class Mat:
             # bsdf.inputs[5].default_value = 0.0      # Specular
             # bsdf.inputs[7].default_value = 1.0      # Roughness
             colorNode = mat.node_tree.nodes.new('ShaderNodeRGB')
-            r = self.pal[64+(colornum*3)]/255
-            g = self.pal[65+(colornum*3)]/255
-            b = self.pal[66+(colornum*3)]/255
+            r, g, b = self.colormap.rgb[colornum].tolist()
             colorNode.outputs[0].default_value = (r, g, b, 1)
             colorNode.location = -400, 250
             vertexColor = mat.node_tree.nodes.new('ShaderNodeAttribute')
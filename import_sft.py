@@ -1,18 +1,21 @@
 from struct import unpack
 import numpy as np
 import bpy
+from os.path import basename, dirname
+from . import jk_image
 
 
 class Sft:
-    def __init__(self, sft, name, ext_pal):
+    def __init__(self, sft, name, colormap):
+        '''takes the decoded Colormap for bitmaps without own palette'''
 
         self.file = sft
         self.name = name.replace(".sft", "")
-        self.palette = ext_pal
+        self.colormap = colormap
 
     def import_Sft(self):
 
-        header = unpack("ccccLLLLLLLLLHH", self.file[0:44])
+        header = unpack("<ccccLLLLLLLLLHH", self.file[0:44])
 
         num_tables = header[8]
 
@@ -22,7 +25,7 @@ class Sft:
             of the CharDef 16bit words.
             '''
             if current_table < num_tables:
-                first_char, last_char = unpack("HH", self.file[char_def_len:char_def_len + 4])
+                first_char, last_char = unpack("<HH", self.file[char_def_len:char_def_len + 4])
                 # new_char_def = char_def + 1 longint (the char_def itself) + length of next char_def
                 char_def_len_new = char_def_len + 4 + (int(last_char) - int(first_char) + 1)*8
                 return header_length(current_table + 1, char_def_len_new)
@@ -32,7 +35,7 @@ class Sft:
         header_bm_start = header_length(0, 40)
 
         header_bm = unpack(
-            "ccccLLLLLLLLLLLLLLLLLL",
+            "<ccccLLLLLLLLLLLLLLLLLL",
             self.file[header_bm_start : header_bm_start + 76]
             )
 
@@ -54,7 +57,7 @@ class Sft:
         Uk9 = header_bm[21]            # = 2 in 16-bit BMs, else = 0
 
         size_x, size_y = unpack(
-            "LL",
+            "<LL",
             self.file[header_bm_start+128:header_bm_start+136]
             )
 
@@ -68,7 +71,19 @@ class Sft:
             height=size_y
             )
 
-        if NumBits == 16:
+        # one float32 rgba buffer, filled in place
+        pixels = jk_image.pixel_buffer(size_y, size_x)
+
+        # decoded images are cached by file and colormap
+        this_addon = basename(dirname(__file__))
+        prefs = bpy.context.preferences.addons[this_addon].preferences
+        cache_key = jk_image.texture_key(self.file, self.colormap.digest)
+        cached = jk_image.load_textures(prefs.temp_folder, cache_key)
+
+        if cached is not None:
+            jk_image.from_uint8(cached['diffuse'], out=pixels)
+
+        elif NumBits == 16:
             flipped_img16 = np.frombuffer(
                 self.file,
                 dtype=np.uint16,
@@ -76,16 +91,10 @@ class Sft:
                 offset=img_start
                 ).reshape((size_y, size_x))
 
+            # image flipped, starts top left in sith engine
+            # blender images start bottom left
             img = np.flipud(flipped_img16)
-            flat_img16 = img.reshape((img_size, 1))
-
-            r = ((flat_img16 & 0b1111100000000000) >> 11) / 31
-            g = ((flat_img16 & 0b0000011111100000) >> 6) / 31
-            b = (flat_img16 & 0b0000000000011111) / 31
-            a = (flat_img16 != Transparent).astype(int)
-
-            col_image = np.hstack((r, g, b, a))
-            pixels = col_image.flatten()
+            jk_image.decode_16bit(img, Transparent, pixels)
 
         else:
             img = np.frombuffer(
@@ -95,6 +104,7 @@ class Sft:
                 offset=img_start
                 ).reshape((size_y, size_x))
 
+            # flipped view, blender images start bottom left
             img_matrix = np.flipud(img)
 
             if PalInc == 2:
@@ -106,18 +116,12 @@ class Sft:
                     ).reshape((256, 3)) / 255
 
             else:
-                pal = np.frombuffer(
-                    self.palette,
-                    dtype=np.uint8,
-                    count=256*3,
-                    offset=64
-                    ).reshape((256, 3)) / 255
+                pal = self.colormap.rgb
 
-            a = np.ones((256, 1))
-            a[Transparent][0] = 0.0
-            pal_alpha_channel = np.hstack((pal, a))
+            pal_alpha_channel = jk_image.palette_table(pal, Transparent)
+            jk_image.gather(pal_alpha_channel, img_matrix, pixels)
 
-            col_image = pal_alpha_channel[img_matrix]
-            pixels = col_image.flatten()
+        if cached is None and prefs.temp_folder:
+            jk_image.save_textures(prefs.temp_folder, cache_key, diffuse=jk_image.to_uint8(pixels))
 
-        image.pixels = pixels
+        jk_image.set_pixels(image, pixels)
@@ -0,0 +1,201 @@
+'''headless batch conversion of the levels / things in a GOB/GOO archive
+
+    blender -b -P <add-on dir>/jk_batch.py -- <archive> [pattern] [options]
+
+e.g. every level of an episode to one .blend each:
+
+    blender -b -P jediknight2blender/jk_batch.py -- \\
+        "Episode/JK1.GOB" "*.jkl" --out levels --jk-resource "Resource"
+
+All assets are imported in the same blender session, so materials and
+images decoded for one level are reused by the following ones.
+Run "blender -b -P jk_batch.py -- --help" for all options.
+'''
+
+import argparse
+import fnmatch
+import importlib
+import os
+import sys
+import time
+
+import bpy
+import addon_utils
+
+
+EXPORT_EXTENSIONS = {
+    'blend': ".blend",
+    'glb': ".glb",
+    'gltf': ".gltf",
+    'fbx': ".fbx",
+    }
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        prog="blender -b -P jk_batch.py --",
+        description="Import levels (.jkl) and things (.3do) from a "
+        "Jedi Knight / MotS archive and save each one to its own file"
+        )
+    parser.add_argument("archive", help="GOB/GOO archive")
+    parser.add_argument(
+        "pattern", nargs="?", default="*.jkl",
+        help="file name glob of the assets to convert (default: *.jkl)"
+        )
+    parser.add_argument("--out", default=".", help="output directory")
+    parser.add_argument(
+        "--format", choices=sorted(EXPORT_EXTENSIONS), default='blend',
+        help="output file format (default: blend)"
+        )
+    parser.add_argument("--jk-resource", default="", help="DF:JK Resource directory")
+    parser.add_argument("--mots-resource", default="", help="MotS Resource directory")
+    parser.add_argument("--temp", default="", help="temporary folder for textures and caches")
+    parser.add_argument(
+        "--source", choices=("DFJK", "MOTS"), default=None,
+        help="source game, if it can't be told from the archive path"
+        )
+    parser.add_argument(
+        "--scale", type=float, default=1.0,
+        help="scale of levels and things, 1.0 = 10 blender units per jk unit"
+        )
+    parser.add_argument("--shader", choices=("BSDF", "VERT", "SOLID"), default='VERT')
+    parser.add_argument("--no-things", action="store_true", help="don't place level things")
+    parser.add_argument("--no-mats", action="store_true", help="don't import materials")
+    parser.add_argument("--no-intensities", action="store_true", help="no vertex lighting")
+    parser.add_argument("--no-alpha", action="store_true", help="no transparency")
+    parser.add_argument("--emission", action="store_true", help="emissive textures")
+    parser.add_argument("--split-sectors", action="store_true", help="one object per sector")
+    parser.add_argument("--cull-adjoins", action="store_true", help="drop hidden adjoin surfaces")
+    parser.add_argument(
+        "--cluster-size", type=int, default=1,
+        help="adjacent sectors per object with --split-sectors (default: 1)"
+        )
+    parser.add_argument(
+        "--pvs-depth", type=int, default=0,
+        help="adjoin depth of the sector visibility sets with --split-sectors "
+        "(default: 0 = unlimited, a limit is approximate)"
+        )
+    return parser.parse_args(argv)
+
+
+def enable_addon():
+    '''enables this add-on from its own directory and returns its
+    package module, so the script doesn't need an installed add-on'''
+    addon_dir = os.path.dirname(os.path.abspath(__file__))
+    package = os.path.basename(addon_dir)
+    sys.path.insert(0, os.path.dirname(addon_dir))
+    # default_set registers the add-on in the preferences, main() needs them
+    if addon_utils.enable(package, default_set=True, persistent=True) is None:
+        raise RuntimeError("couldn't enable the add-on " + package)
+    return importlib.import_module(package)
+
+
+def clear_scene(scene):
+    '''removes the objects and collections of the last asset, materials
+    and images stay for the next one'''
+    for ob in list(scene.objects):
+        bpy.data.objects.remove(ob)
+    for collection in list(scene.collection.children):
+        bpy.data.collections.remove(collection)
+    for mesh in [mesh for mesh in bpy.data.meshes if mesh.users == 0]:
+        bpy.data.meshes.remove(mesh)
+    if "jk_levels" in scene:
+        del scene["jk_levels"]
+
+
+def export(filepath, file_format):
+    if file_format == 'blend':
+        bpy.ops.wm.save_as_mainfile(filepath=filepath, copy=True)
+    elif file_format in ('glb', 'gltf'):
+        bpy.ops.export_scene.gltf(
+            filepath=filepath,
+            export_format='GLB' if file_format == 'glb' else 'GLTF_SEPARATE'
+            )
+    elif file_format == 'fbx':
+        bpy.ops.export_scene.fbx(filepath=filepath, path_mode='COPY', embed_textures=True)
+
+
+def main(argv):
+    args = parse_args(argv)
+    addon = enable_addon()
+
+    prefs = bpy.context.preferences.addons[addon.__name__].preferences
+    prefs.jkdf_path = args.jk_resource
+    prefs.mots_path = args.mots_resource
+    prefs.temp_folder = args.temp
+
+    archive = os.path.abspath(args.archive)
+    gob = addon.open_gob(archive, args.temp or None)
+    motsflag = archive.lower().endswith(".goo")
+    source = args.source or ("MOTS" if motsflag else "DFJK")
+
+    pattern = args.pattern.lower()
+    assets = sorted(
+        name for name in gob.get_gobed_files()
+        if fnmatch.fnmatch(name.lower(), pattern)
+        )
+    if not assets:
+        print("no files matching " + args.pattern + " in " + archive)
+        return 1
+
+    os.makedirs(args.out, exist_ok=True)
+    scene = bpy.context.scene
+    timings = []
+
+    for filename in assets:
+        name, ext = os.path.splitext(filename)
+        ext = ext.lower()
+        start = time.perf_counter()
+        status = "ok"
+        try:
+            clear_scene(scene)
+            ungobed_file = gob.ungob(filename)
+            if ext == ".jkl":
+                level = addon.Level(
+                    os.path.join(archive, filename),
+                    not args.no_things,
+                    not args.no_mats,
+                    not args.no_intensities,
+                    args.emission,
+                    not args.no_alpha,
+                    args.scale,
+                    args.shader,
+                    False,
+                    source,
+                    gob_file=archive,
+                    split_sectors=args.split_sectors,
+                    cull_adjoins=args.cull_adjoins,
+                    pvs_depth=args.pvs_depth,
+                    cluster_size=args.cluster_size
+                    )
+                level.open_from_gob(ungobed_file)
+                level.import_Level()
+            elif ext == ".3do":
+                thing = addon.Thing(
+                    ungobed_file, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0,
+                    args.scale * 10.0, filename, motsflag, not args.no_mats
+                    )
+                thing.import_Thing()
+            else:
+                status = "skipped, " + ext + " not supported"
+            if status == "ok":
+                export(
+                    os.path.join(os.path.abspath(args.out), name + EXPORT_EXTENSIONS[args.format]),
+                    args.format
+                    )
+        except Exception as exception:
+            status = "failed, " + type(exception).__name__ + ": " + str(exception)
+        timings.append((filename, time.perf_counter() - start, status))
+        print("%-24s %8.2fs  %s" % timings[-1])
+
+    print("\n%d assets, %.2fs" % (len(timings), sum(timing[1] for timing in timings)))
+    for filename, seconds, status in timings:
+        print("%-24s %8.2fs  %s" % (filename, seconds, status))
+
+    failed = sum(1 for timing in timings if timing[2].startswith("failed"))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    argv = sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else []
+    sys.exit(main(argv))
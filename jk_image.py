@@ -0,0 +1,235 @@
+import hashlib
+import os
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+
+# decoded textures are cached in <temp folder>/texture_cache/<key>.npz as
+# uint8 rgba images, keyed by a hash of everything the decoding depends on.
+# trim_texture_cache() keeps it below MAX_TEXTURE_CACHE_BYTES, the least
+# recently used files are removed first
+
+TEXTURE_CACHE_DIR = "texture_cache"
+TEXTURE_CACHE_VERSION = "2"     # bumped when the decoding changes
+MAX_TEXTURE_CACHE_BYTES = 512 * 1024 * 1024
+
+
+def pixel_buffer(height, width):
+    '''preallocated float32 rgba buffer (height, width, 4) of an image'''
+    return np.empty((height, width, 4), dtype=np.float32)
+
+
+def gather(table, indices, out):
+    '''fills out (indices.shape + (4,)) with the rows of a float32 rgba
+    lookup table picked by palette indices, without temporaries'''
+    # uint8 indices can't be out of range, clip skips the buffered check
+    np.take(table, indices, axis=0, out=out, mode='clip')
+    return out
+
+
+def palette_table(rgb, transparent=None):
+    '''float32 rgba lookup table of a (256, 3) palette,
+    the transparent palette index gets alpha 0'''
+    table = np.ones((256, 4), dtype=np.float32)
+    table[:, :3] = rgb
+    if transparent is not None and 0 <= transparent < 256:
+        table[transparent, 3] = 0.0
+    return table
+
+
+def decode_16bit(img16, transparent, out):
+    '''fills out with the rgba of 16 bit rgb565 bitmap pixels (5 bit red,
+    6 bit green, 5 bit blue), pixels of the transparent value get alpha 0'''
+    scale5 = np.float32(1 / 31)
+    scale6 = np.float32(1 / 63)
+    np.multiply((img16 & 0b1111100000000000) >> 11, scale5, out=out[..., 0], casting='unsafe')
+    np.multiply((img16 & 0b0000011111100000) >> 5, scale6, out=out[..., 1], casting='unsafe')
+    np.multiply(img16 & 0b0000000000011111, scale5, out=out[..., 2], casting='unsafe')
+    np.not_equal(img16, transparent, out=out[..., 3], casting='unsafe')
+    return out
+
+
+def set_pixels(image, pixels):
+    '''uploads a float32 rgba buffer to a blender image'''
+    pixels = pixels.reshape(-1)
+    try:
+        image.pixels.foreach_set(pixels)
+    except (AttributeError, TypeError):
+        # blender before 2.83
+        image.pixels[:] = pixels
+
+
+def to_uint8(pixels):
+    '''float32 rgba buffer -> uint8 rgba, for the texture cache'''
+    return np.rint(pixels * np.float32(255)).astype(np.uint8)
+
+
+def from_uint8(pixels, out=None):
+    '''uint8 rgba -> float32 rgba buffer, filled in place'''
+    if out is None:
+        out = np.empty(pixels.shape, dtype=np.float32)
+    np.multiply(pixels, np.float32(1 / 255), out=out, casting='unsafe')
+    return out
+
+
+def texture_key(*parts):
+    '''sha1 of the raw file bytes, colormap digest and
+    decode flags (bytes-like or str) a texture is built from'''
+    key = hashlib.sha1(TEXTURE_CACHE_VERSION.encode("utf-8"))
+    for part in parts:
+        key.update(part.encode("utf-8") if isinstance(part, str) else part)
+    return key.hexdigest()
+
+
+def cache_file(temp_folder, key):
+    return os.path.join(temp_folder, TEXTURE_CACHE_DIR, key + ".npz")
+
+
+def load_textures(temp_folder, key):
+    '''returns the cached arrays of a key as a dict,
+    None without temp folder or on a cache miss'''
+    if not temp_folder:
+        return None
+    path = cache_file(temp_folder, key)
+    if not os.path.isfile(path):
+        return None
+    try:
+        with np.load(path, allow_pickle=False) as cache:
+            arrays = {name: cache[name] for name in cache.files}
+    except Exception:
+        # truncated or corrupt file (BadZipFile, EOFError, ...),
+        # decoded again and rewritten like any other miss
+        return None
+    try:
+        os.utime(path)      # recently used, for trim_texture_cache()
+    except OSError:
+        pass
+    return arrays
+
+
+def save_textures(temp_folder, key, **arrays):
+    '''stores the arrays of a key (uint8 rgba images and metadata),
+    written to a temporary file first, so readers never see half a file'''
+    if not temp_folder:
+        return
+    path = cache_file(temp_folder, key)
+    temp_path = path + ".%d.tmp" % os.getpid()
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(temp_path, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(temp_path, path)
+    except OSError:
+        print("couldn't write texture cache " + path)
+
+
+def trim_texture_cache(temp_folder, max_bytes=MAX_TEXTURE_CACHE_BYTES):
+    '''removes the least recently used cache files until the texture
+    cache is at most max_bytes. Returns the number of removed files'''
+    if not temp_folder:
+        return 0
+    files = []
+    try:
+        with os.scandir(os.path.join(temp_folder, TEXTURE_CACHE_DIR)) as entries:
+            for entry in entries:
+                if entry.name.endswith(".npz") and entry.is_file():
+                    stat = entry.stat()
+                    files.append((stat.st_mtime, stat.st_size, entry.path))
+    except OSError:
+        return 0
+
+    size = sum(file[1] for file in files)
+    removed = 0
+    for mtime, file_size, path in sorted(files):
+        if size <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        size -= file_size
+        removed += 1
+    return removed
+
+
+def clear_texture_cache(temp_folder):
+    '''removes all cached textures of the temp folder'''
+    return trim_texture_cache(temp_folder, 0)
+
+
+# png files of the temp folder are encoded and written on a thread pool
+# (zlib releases the GIL), flush_pngs() waits until all of them exist
+
+PNG_WRITERS = min(4, os.cpu_count() or 1)
+
+png_pool = None
+png_pending = []        # (future, image name)
+
+
+def encode_png(rgba):
+    '''uint8 rgba (height, width, 4), bottom row first like blender
+    pixels -> png file bytes'''
+    height, width = rgba.shape[:2]
+    raw = np.empty((height, 1 + width * 4), dtype=np.uint8)
+    raw[:, 0] = 0                                       # filter type none
+    raw[:, 1:] = rgba[::-1].reshape((height, width * 4))  # png starts top left
+
+    def chunk(tag, data):
+        return (
+            struct.pack(">L", len(data)) + tag + data
+            + struct.pack(">L", zlib.crc32(tag + data) & 0xffffffff)
+            )
+
+    return b"".join((
+        b"\x89PNG\r\n\x1a\n",
+        chunk(b"IHDR", struct.pack(">LLBBBBB", width, height, 8, 6, 0, 0, 0)),
+        chunk(b"IDAT", zlib.compress(raw.tobytes(), 6)),
+        chunk(b"IEND", b""),
+        ))
+
+
+def write_png(path, rgba):
+    temp_path = path + ".tmp"
+    with open(temp_path, 'wb') as f:
+        f.write(encode_png(rgba))
+    os.replace(temp_path, path)
+    return path
+
+
+def write_png_async(image, path, rgba):
+    '''queues uint8 rgba pixels of a blender image to be written as png
+    to path, the image becomes a file image at the next flush_pngs()'''
+    global png_pool
+    if png_pool is None:
+        png_pool = ThreadPoolExecutor(max_workers=PNG_WRITERS, thread_name_prefix="jk_png")
+    image.filepath_raw = path
+    image.file_format = 'PNG'
+    png_pending.append((png_pool.submit(write_png, path, rgba), image.name))
+
+
+def flush_pngs(images=None):
+    '''waits for all queued png files, then switches their images
+    (bpy.data.images) to the written files. Returns the number written'''
+    written = 0
+    while png_pending:
+        future, name = png_pending.pop(0)
+        try:
+            future.result()
+        except OSError as exception:
+            print("couldn't write " + name + ".png: " + str(exception))
+            continue
+        written += 1
+        if images is not None and name in images:
+            images[name].source = 'FILE'
+    return written
+
+
+def shutdown_png_writer():
+    '''finishes the queued files and stops the worker threads'''
+    global png_pool
+    flush_pngs()
+    if png_pool is not None:
+        png_pool.shutdown()
+        png_pool = None
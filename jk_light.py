@@ -0,0 +1,36 @@
+import numpy as np
+
+
+def loop_colors(intensities, loop_face, face_extralight, face_sector,
+                sector_extralight, sector_ambient=None, sector_tint=None):
+    '''computes vertex colors of all loops in bulk, returns rgba (loops, 4).
+
+    intensities: per loop, (loops,) DF:JK mono or (loops, 4) MotS
+    (intensity, r, g, b). face_sector indexes the per sector arrays, -1 for
+    faces without sector (the per sector arrays get a dark row appended).
+    The light of a loop is intensity + surface extralight + sector
+    extralight. sector_ambient raises it to the sector's ambient light and
+    sector_tint (sectors, 3) multiplies it; both are optional, the engine
+    applies them to things, not to level geometry'''
+    def per_loop(sector_values):
+        sector_values = np.asarray(sector_values, dtype=np.float32)
+        dark = np.zeros((1,) + sector_values.shape[1:], dtype=np.float32)
+        sector_values = np.concatenate((sector_values, dark))
+        return sector_values[face_sector[loop_face]]
+
+    extralight = face_extralight[loop_face] + per_loop(sector_extralight)
+
+    colors = np.ones((len(loop_face), 4), dtype=np.float32)
+    rgb = colors[:, :3]
+    if intensities.ndim == 2:
+        np.add(intensities[:, 1:4], extralight[:, None], out=rgb)
+    else:
+        rgb[:] = (intensities + extralight)[:, None]
+
+    if sector_ambient is not None:
+        np.maximum(rgb, per_loop(sector_ambient)[:, None], out=rgb)
+    if sector_tint is not None:
+        rgb *= per_loop(sector_tint)
+
+    np.clip(rgb, 0.0, 1.0, out=rgb)
+    return colors
@@ -0,0 +1,71 @@
+import bpy
+import numpy as np
+
+
+def build_mesh(me, verts, loop_start, loop_total, vertex_indices):
+    '''fills an empty mesh from flat arrays: verts (N, 3), per face
+    loop_start / loop_total and the vertex index of every loop'''
+    me.vertices.add(len(verts))
+    me.vertices.foreach_set("co", np.ascontiguousarray(verts, dtype=np.float32).ravel())
+
+    me.loops.add(len(vertex_indices))
+    me.loops.foreach_set("vertex_index", np.ascontiguousarray(vertex_indices, dtype=np.int32))
+
+    me.polygons.add(len(loop_start))
+    me.polygons.foreach_set("loop_start", np.ascontiguousarray(loop_start, dtype=np.int32))
+    if bpy.app.version < (4, 0, 0):
+        # read only since 4.0, derived from loop_start
+        me.polygons.foreach_set("loop_total", np.ascontiguousarray(loop_total, dtype=np.int32))
+
+    me.update(calc_edges=True)
+
+
+def compact_vertices(verts, vertex_indices):
+    '''returns only the verts used by vertex_indices and the
+    indices renumbered to them, for meshes of a part of the level'''
+    used, vertex_indices = np.unique(vertex_indices, return_inverse=True)
+    return verts[used], vertex_indices.astype(np.int32)
+
+
+def set_uvs(me, uvs, name="UVMap"):
+    '''adds an uv map from per loop uvs (loops, 2)'''
+    uv_layer = me.uv_layers.new(name=name)
+    uv_layer.data.foreach_set("uv", np.ascontiguousarray(uvs, dtype=np.float32).ravel())
+    return uv_layer
+
+
+def set_colors(me, colors, name):
+    '''adds a face corner color layer from per loop rgba (loops, 4),
+    values are sRGB like the legacy vertex colors'''
+    colors = np.ascontiguousarray(colors, dtype=np.float32).ravel()
+    if hasattr(me, "vertex_colors"):
+        layer = me.vertex_colors.new(name=name)
+        layer.data.foreach_set("color", colors)
+    else:
+        layer = me.color_attributes.new(name=name, type='BYTE_COLOR', domain='CORNER')
+        layer.data.foreach_set("color_srgb", colors)
+    return layer
+
+
+def texture_table(names, tiling=None, default_size=16.0):
+    '''returns a float32 table with one row (width, height, x tile, y tile)
+    per material name, taken from the image of the same name, and a
+    default row at [-1] for faces without material'''
+    table = np.empty((len(names) + 1, 4), dtype=np.float32)
+    table[:, :2] = default_size
+    table[:, 2:] = 1.0
+    for i, name in enumerate(names):
+        image = bpy.data.images.get(name)
+        if image is not None and image.size[0] != 0:
+            table[i, :2] = image.size
+    if tiling:
+        table[:len(tiling), 2:] = tiling
+    return table
+
+
+def loop_uvs(uvs, uv_indices, loop_material, textures):
+    '''normalises texel uvs of every loop by the texture size of its
+    material (rows of a texture_table), v flipped to blender direction'''
+    loop_uvs = uvs[uv_indices] / textures[loop_material, :2]
+    loop_uvs[:, 1] *= -1.0
+    return loop_uvs
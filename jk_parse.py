@@ -1,28 +1,27 @@
 import re
+import warnings
+import numpy as np
 
-# jkl world regular expressions
-
-WORLD_MATERIALS_RE = re.compile(r"World materials\s(\d+)")
-WORLD_COLORMAPS_RE = re.compile(r"World Colormaps\s(\d+)")
-WORLD_VERTICES_RE = re.compile(r"World vertices\s(\d+)")
-WORLD_UVS_RE = re.compile(r"World texture vertices\s(\d+)")
-WORLD_ADJOINS_RE = re.compile(r"World adjoins\s(\d+)")
-WORLD_SURFACES_RE = re.compile(r"World surfaces\s(\d+)")
-WORLD_SECTORS_RE = re.compile(r"World sectors\s(\d+)")
-WORLD_MODELS_RE = re.compile(r"World models\s(\d+)")
-WORLD_TEMPLATES_RE = re.compile(r"World templates\s(\d+)")
-WORLD_THINGS_RE = re.compile(r"World things\s(\d+)")
-
-# jkl sectors regular expressions
-
-SECTOR_RE = re.compile(r"SECTOR\s(\d+)")
-SECTOR_AMBIENT_RE = re.compile(r"AMBIENT LIGHT\s(-?\d*\.?\d*)")
-SECTOR_EXTRA_RE = re.compile(r"EXTRA LIGHT\s(-?\d*\.?\d*)")
-SECTOR_TINT_RE = re.compile(r"TINT\s(-?\d*\.?\d*)\s(-?\d*\.?\d*)\s(-?\d*\.?\d*)")
-SECTOR_BOUNDBOX_RE = re.compile(r"BOUNDBOX\s(-?\d*\.?\d*)\s(-?\d*\.?\d*)\s(-?\d*\.?\d*)\s(-?\d*\.?\d*)\s(-?\d*\.?\d*)\s(-?\d*\.?\d*)")
-SECTOR_CENTER_RE = re.compile(r"CENTER\s(-?\d*\.?\d*)\s(-?\d*\.?\d*)\s(-?\d*\.?\d*)")
-SECTOR_RADIUS_RE = re.compile(r"RADIUS\s(-?\d*\.?\d*)")
-SECTOR_SURFACES_RE = re.compile(r"SURFACES\s(\d+)\s(\d+)")
+# jkl section headers ("SECTION: GEORESOURCE", "World vertices 1234"),
+# matched on the raw file bytes
+
+JKL_HEADER_RE = re.compile(
+    rb"^[ \t]*(?:SECTION:[ \t]*(\w+)|World[ \t]+([A-Za-z][A-Za-z ]*?)[ \t]+(\d+))[ \t\r]*$",
+    re.M
+    )
+
+# comments, from "#" or "//" to the end of the line
+
+COMMENT_RE = re.compile(r"(#|//)[^\n]*")
+
+# numeric sections are parsed from the raw bytes, ":" of the row numbers
+# and "," of the vertex / uv pairs separate like whitespace
+
+NUMBER_SEPARATORS = bytes.maketrans(b":,", b"  ")
+
+# jkl things regular expression
+#                  num     template  name    x              y              z              pitch          yaw            roll           sector   params
+THING_RE = re.compile(r"(\d+):\s+(\S+)\s+(\S+)\s+(-?\d*\.?\d*)\s+(-?\d*\.?\d*)\s+(-?\d*\.?\d*)\s+(-?\d*\.?\d*)\s+(-?\d*\.?\d*)\s+(-?\d*\.?\d*)\s+(-?\d+)(.*)")
 
 # 3do regular expressions
 
@@ -32,4 +31,441 @@ OBJ_UVS_RE = re.compile(r"^TEXTURE VERTICES\s(\d+)")
 OBJ_FACES_RE = re.compile(r"^FACES\s(\d+)")
 OBJ_MESHES_RE = re.compile(r"^MESHES\s(\d+)")
 OBJ_MESH_RE = re.compile(r"^MESH\s(\d+)")
-OBJ_HIERARCHY_RE = re.compile(r"^HIERARCHY NODES\s(\d+)")
\ No newline at end of file
+OBJ_HIERARCHY_RE = re.compile(r"^HIERARCHY NODES\s(\d+)")
+
+
+def index_sections(data):
+    '''scans the raw jkl bytes (bytes, mmap or memoryview) once for all
+    section headers, nothing is decoded. Returns a dict "SECTION: NAME" /
+    "World name" -> (count, start, end, line), with the count of a World
+    header (0 for SECTION), the byte range of the lines up to the next
+    header and the line number of the header. A repeated header keeps
+    its first occurrence'''
+    newlines = np.frombuffer(data, dtype=np.uint8) == 10
+    sections = {}
+    line = 0
+    last_offset = 0
+    last_key = None
+    for match in JKL_HEADER_RE.finditer(data):
+        offset = match.start()
+        line += int(np.count_nonzero(newlines[last_offset:offset]))
+        last_offset = offset
+        if match.group(1):
+            key = "SECTION: " + match.group(1).decode("ISO-8859-1").upper()
+            count = 0
+        else:
+            key = "World " + match.group(2).decode("ISO-8859-1").lower()
+            count = int(match.group(3))
+        if last_key is not None:
+            # the previous section ends at this header
+            count_, start, end, line_ = sections[last_key]
+            sections[last_key] = (count_, start, offset, line_)
+        if key in sections:
+            last_key = None
+            continue
+        sections[key] = (count, match.end() + 1, len(data), line)
+        last_key = key
+    return sections
+
+
+def section_count(sections, header):
+    '''returns the count of a World header, 0 if it is missing'''
+    if header not in sections:
+        return 0
+    return sections[header][0]
+
+
+def section_text(data, sections, header):
+    '''decodes only the lines between a header and the next header,
+    empty if the header is missing'''
+    if header not in sections:
+        return ""
+    count, start, end, line = sections[header]
+    if start >= end:
+        return ""
+    return str(data[start:end], "ISO-8859-1")
+
+
+def section_bytes(data, sections, header):
+    '''the raw bytes between a header and the next header (a slice of
+    data, no copy for a memoryview), empty if the header is missing'''
+    if header not in sections:
+        return b""
+    count, start, end, line = sections[header]
+    return data[start:end]
+
+
+def parse_list(block, count):
+    '''returns the fields after the row number of the first count
+    "num: field field ..." rows of a section block, stops at "end"'''
+    rows = []
+    for line in COMMENT_RE.sub("", block).splitlines():
+        if len(rows) >= count:
+            break
+        fields = line.split()
+        if not fields:
+            continue
+        if fields[0].lower() == "end":
+            break
+        if fields[0][-1] == ":":
+            rows.append(fields[1:])
+    return rows
+
+
+def number_text(block):
+    '''copy of the raw bytes of a section block for np.fromstring,
+    comments and the ":" / "," separators replaced by spaces'''
+    text = bytes(block).translate(NUMBER_SEPARATORS)
+    if b"#" not in text and b"//" not in text:
+        return text
+
+    # few comments per section, blanked one by one
+    text = bytearray(text)
+    for marker in (b"#", b"//"):
+        start = text.find(marker)
+        while start != -1:
+            end = text.find(b"\n", start)
+            if end == -1:
+                end = len(text)
+            text[start:end] = b" " * (end - start)
+            start = text.find(marker, end)
+    return bytes(text)
+
+
+def read_numbers(text, dtype):
+    '''whitespace separated numbers of text (str or bytes) as an array,
+    in a single np.fromstring call. Raises ValueError if any token
+    isn't a number'''
+    with warnings.catch_warnings():
+        # older numpy only warns and returns the numbers up to the token
+        warnings.simplefilter("error", DeprecationWarning)
+        try:
+            return np.fromstring(text, dtype=dtype, sep=" ")
+        except DeprecationWarning as warning:
+            raise ValueError(str(warning))
+
+
+def parse_rows(block, count, columns):
+    '''parses the first count "num: value value ..." rows of the raw
+    bytes of a section block in bulk, returns a float32 array of shape
+    (count, columns)'''
+    width = columns + 1
+    try:
+        values = read_numbers(number_text(block), np.float32)
+    except ValueError:
+        # something else follows the rows ("end", ...)
+        values = parse_numbers(block).astype(np.float32)
+    if len(values) < count * width:
+        raise ValueError("section has less than %d rows" % count)
+    return values[:count * width].reshape((count, width))[:, 1:]
+
+
+def parse_numbers(block, rows=False):
+    '''all numbers of the raw bytes of a section block as one float64
+    array, in order, up to the first token that isn't a number.
+    "0x.." tokens are hexadecimal. With rows, the index of the first
+    number of every line is returned as well'''
+    text = bytearray(number_text(block))
+    chars = np.frombuffer(text, dtype=np.uint8)
+    space = chars <= 32
+    starts = np.flatnonzero(~space & np.concatenate(([True], space[:-1])))
+    ends = np.flatnonzero(~space & np.concatenate((space[1:], [True]))) + 1
+
+    # hex tokens: decoded digit by digit, then blanked to "0"
+    is_hex = (
+        (ends - starts > 2)
+        & (chars[starts] == 48)
+        & (chars[np.minimum(starts + 1, len(chars) - 1)] | 32 == 120)
+        )
+    hex_start = starts[is_hex] + 2
+    hex_length = ends[is_hex] - hex_start
+    positions = hex_start[:, None] + np.arange(hex_length.max(initial=0))
+    in_token = positions < ends[is_hex][:, None]
+    digits = chars[np.where(in_token, positions, 0)].astype(np.int64)
+    digits = np.where(digits <= 57, digits - 48, (digits | 32) - 87)
+    exponents = np.maximum(hex_length[:, None] - 1 - np.arange(positions.shape[1]), 0)
+    hex_values = np.sum(np.where(in_token, digits << (4 * exponents), 0), axis=1)
+    chars[hex_start - 1] = 32
+    chars[positions[in_token]] = 32
+
+    # stop at the first token with a character no number has
+    number_chars = np.zeros(256, dtype=bool)
+    number_chars[list(b"0123456789.+-eE")] = True
+    bad = np.flatnonzero((chars > 32) & ~number_chars[chars])
+    count = len(starts)
+    if len(bad):
+        count = int(np.searchsorted(starts, bad[0], side='right')) - 1
+    end = starts[count] if count < len(starts) else len(chars)
+
+    values = read_numbers(chars[:end].tobytes(), np.float64)
+    if len(values) != count:
+        raise ValueError("malformed number in section")
+    hex_tokens = np.flatnonzero(is_hex[:count])
+    values[hex_tokens] = hex_values[:len(hex_tokens)]
+    if not rows:
+        return values
+
+    line = np.searchsorted(np.flatnonzero(chars == 10), starts[:count])
+    return values, np.flatnonzero(np.diff(line, prepend=-1))
+
+
+class Surfaces:
+    '''world surfaces as flat arrays (CSR): the loops of face f are
+    loop_start[f] : loop_start[f] + loop_total[f] in the per-loop arrays'''
+
+    def __init__(self, block, count, motsflag):
+        '''parses count surface rows of the raw bytes of a "World surfaces"
+        section block, one surface per line. MotS has 4 light values per
+        loop (intensity, r, g, b)'''
+        values, lines = parse_numbers(block, rows=True)
+        light_width = 4 if motsflag else 1
+        if len(lines) < count:
+            raise ValueError("section has less than %d rows" % count)
+
+        # a row has 10 columns, nverts * (vertex, uv) and the intensities
+        starts = lines[:count]
+        row_end = np.append(lines, len(values))[1:count + 1]
+        if np.any(row_end - starts < 10):
+            raise ValueError("surface row with less than 10 columns")
+        nverts = values[starts + 9].astype(np.int64)
+        if np.any(row_end - starts < 10 + nverts * (2 + light_width)):
+            raise ValueError("surface row shorter than its vertex count")
+
+        #  num: mat surfflags faceflags geo light tex adjoin extralight nverts
+        head = values[starts[:, None] + np.arange(10)]
+        self.material = head[:, 1].astype(np.int32)
+        self.surfflags = head[:, 2].astype(np.uint32)
+        self.faceflags = head[:, 3].astype(np.uint32)
+        self.geo = head[:, 4].astype(np.int32)          # 0 = don't draw, 4 = textured
+        self.light = head[:, 5].astype(np.int32)
+        self.tex = head[:, 6].astype(np.int32)
+        self.adjoin = head[:, 7].astype(np.int32)
+        self.extralight = head[:, 8].astype(np.float32)
+
+        self.loop_total = nverts.astype(np.int32)
+        self.loop_start = (np.cumsum(nverts) - nverts).astype(np.int32)
+
+        # per loop: owning face and position within the face
+        self.loop_face = np.repeat(np.arange(count, dtype=np.int32), nverts)
+        corner = np.arange(len(self.loop_face)) - self.loop_start[self.loop_face]
+
+        vertex_pos = starts[self.loop_face] + 10 + 2 * corner
+        self.vertex_indices = values[vertex_pos].astype(np.int32)
+        self.uv_indices = values[vertex_pos + 1].astype(np.int32)
+
+        light_pos = starts[self.loop_face] + 10 + 2 * nverts[self.loop_face] + light_width * corner
+        intensities = values[light_pos[:, None] + np.arange(light_width)].astype(np.float32)
+        if not motsflag:
+            intensities = intensities[:, 0]
+        self.intensities = intensities              # (loops,) or (loops, 4)
+        self.source_face = np.arange(count, dtype=np.int32)
+
+    def __len__(self):
+        return len(self.loop_start)
+
+    def select(self, faces):
+        '''returns the given faces as a new Surfaces with renumbered loops,
+        source_face keeps their index in the world surfaces'''
+        faces = np.asarray(faces, dtype=np.int64)
+        subset = Surfaces.__new__(Surfaces)
+        for column in ("material", "surfflags", "faceflags", "geo", "light",
+                       "tex", "adjoin", "extralight", "loop_total", "source_face"):
+            setattr(subset, column, getattr(self, column)[faces])
+
+        loop_total = subset.loop_total
+        subset.loop_start = (np.cumsum(loop_total) - loop_total).astype(np.int32)
+        subset.loop_face = np.repeat(np.arange(len(faces), dtype=np.int32), loop_total)
+        loops = (
+            self.loop_start[faces][subset.loop_face]
+            + np.arange(len(subset.loop_face))
+            - subset.loop_start[subset.loop_face]
+            )
+        subset.vertex_indices = self.vertex_indices[loops]
+        subset.uv_indices = self.uv_indices[loops]
+        subset.intensities = self.intensities[loops]
+        return subset
+
+
+class Adjoins:
+    '''world adjoins as arrays. An adjoin is the portal side of a surface,
+    its mirror is the adjoin on the surface facing back'''
+
+    # adjoin flags
+    VISIBLE = 0x1           # render through
+    PASSABLE = 0x2          # things move through
+
+    def __init__(self, block, count):
+        '''parses count "num: flags mirror dist" rows of the raw bytes
+        of a "World adjoins" section block'''
+        values = parse_numbers(block)
+        if len(values) < count * 4:
+            raise ValueError("section has less than %d rows" % count)
+        rows = values[:count * 4].reshape((count, 4))
+        self.flags = rows[:, 1].astype(np.uint32)
+        self.mirror = rows[:, 2].astype(np.int32)
+        self.dist = rows[:, 3].astype(np.float32)
+
+    def __len__(self):
+        return len(self.mirror)
+
+    def sector_graph(self, surface_adjoin, face_sector, sector_count):
+        '''returns the sector connectivity as CSR arrays (indptr, sectors,
+        adjoins): the adjoins of sector s lead to sectors[indptr[s]:indptr[s+1]],
+        adjoins holds the adjoin index of every edge for its flags'''
+        adjoin_sector = np.full(len(self), -1, dtype=np.int32)
+        portals = np.flatnonzero((surface_adjoin > -1) & (surface_adjoin < len(self)))
+        adjoin_sector[surface_adjoin[portals]] = face_sector[portals]
+
+        mirror = self.mirror
+        valid = (mirror > -1) & (mirror < len(self))
+        source = adjoin_sector
+        target = np.where(valid, adjoin_sector[np.where(valid, mirror, 0)], -1)
+        edges = np.flatnonzero((source > -1) & (target > -1))
+
+        edges = edges[np.argsort(source[edges], kind='stable')]
+        indptr = np.zeros(sector_count + 1, dtype=np.int32)
+        np.cumsum(np.bincount(source[edges], minlength=sector_count), out=indptr[1:])
+        return indptr, target[edges].astype(np.int32), edges.astype(np.int32)
+
+
+class Sectors:
+    '''world sectors as arrays, one row per sector. The vertex lists are
+    CSR like Surfaces: vertex_indices[vertex_start[s]:][:vertex_count[s]]'''
+
+    def __init__(self, block, count):
+        '''parses a "World sectors" section block in a single pass,
+        dispatching on the first keyword of every line'''
+        self.flags = np.zeros(count, dtype=np.uint32)
+        self.ambient = np.zeros(count, dtype=np.float32)
+        self.extra = np.zeros(count, dtype=np.float32)
+        self.colormap = np.zeros(count, dtype=np.int32)
+        self.tint = np.zeros((count, 3), dtype=np.float32)
+        self.boundbox = np.zeros((count, 6), dtype=np.float32)
+        self.collidebox = np.full((count, 6), np.nan, dtype=np.float32)
+        self.center = np.zeros((count, 3), dtype=np.float32)
+        self.radius = np.zeros(count, dtype=np.float32)
+        self.thrust = np.zeros((count, 3), dtype=np.float32)
+        self.sound = [None] * count
+        self.sound_volume = np.zeros(count, dtype=np.float32)
+        self.surface_start = np.zeros(count, dtype=np.int32)
+        self.surface_count = np.zeros(count, dtype=np.int32)
+        self.vertex_count = np.zeros(count, dtype=np.int32)
+        vertex_indices = []
+
+        sector = -1
+        for line in COMMENT_RE.sub("", block).splitlines():
+            fields = line.split()
+            if not fields:
+                continue
+            key = fields[0]
+
+            if key[-1] == ":":                      # "0: 12" vertex list
+                vertex_indices.append(int(fields[1]))
+            elif key == "SECTOR":
+                sector = int(fields[1])
+            elif key == "FLAGS":
+                self.flags[sector] = int(fields[1], 16)
+            elif key == "AMBIENT":                  # AMBIENT LIGHT
+                self.ambient[sector] = float(fields[2])
+            elif key == "EXTRA":                    # EXTRA LIGHT
+                self.extra[sector] = float(fields[2])
+            elif key == "COLORMAP":
+                self.colormap[sector] = int(fields[1])
+            elif key == "TINT":
+                self.tint[sector] = fields[1:4]
+            elif key == "BOUNDBOX":
+                self.boundbox[sector] = fields[1:7]
+            elif key == "COLLIDEBOX":
+                self.collidebox[sector] = fields[1:7]
+            elif key == "SOUND":
+                self.sound[sector] = fields[1]
+                self.sound_volume[sector] = float(fields[2])
+            elif key == "CENTER":
+                self.center[sector] = fields[1:4]
+            elif key == "RADIUS":
+                self.radius[sector] = float(fields[1])
+            elif key == "THRUST":
+                self.thrust[sector] = fields[1:4]
+            elif key == "VERTICES":
+                self.vertex_count[sector] = int(fields[1])
+            elif key == "SURFACES":
+                self.surface_start[sector] = int(fields[1])
+                self.surface_count[sector] = int(fields[2])
+
+        self.vertex_indices = np.array(vertex_indices, dtype=np.int32)
+        self.vertex_start = (np.cumsum(self.vertex_count) - self.vertex_count).astype(np.int32)
+
+    def __len__(self):
+        return len(self.radius)
+
+    def surface_sector(self, surface_count):
+        '''returns the sector of every surface, -1 for surfaces
+        not listed by any sector'''
+        surface_sector = np.full(surface_count, -1, dtype=np.int32)
+        sector_of_range = np.repeat(np.arange(len(self), dtype=np.int32), self.surface_count)
+        offsets = np.arange(len(sector_of_range)) - np.repeat(
+            np.cumsum(self.surface_count) - self.surface_count,
+            self.surface_count
+            )
+        surfaces = self.surface_start[sector_of_range] + offsets
+        valid = surfaces < surface_count
+        surface_sector[surfaces[valid]] = sector_of_range[valid]
+        return surface_sector
+
+
+def parse_params(fields):
+    '''returns a dict of the "key=value" fields, keys in lower case'''
+    params = {}
+    for field in fields:
+        key, sep, value = field.partition("=")
+        if sep:
+            params[key.lower()] = value
+    return params
+
+
+class Templates:
+    '''world templates by lower case name. Parameters of the base
+    templates are flattened into each template on first lookup'''
+
+    def __init__(self, block):
+        '''parses a "World templates" section block,
+        "name  based_on  key=value key=value ..." per line'''
+        self.templates = {}     # name -> (base name, own params)
+        self.resolved = {}      # name -> params incl. inherited ones
+        for line in COMMENT_RE.sub("", block).splitlines():
+            fields = line.split()
+            if len(fields) < 2 or fields[0].lower() == "end":
+                continue
+            self.templates[fields[0].lower()] = (
+                fields[1].lower(),
+                parse_params(fields[2:])
+                )
+
+    def __contains__(self, name):
+        return name.lower() in self.templates
+
+    def params(self, name):
+        '''returns the params of a template merged over those of its
+        base templates, empty for unknown templates or "none"'''
+        name = name.lower()
+        params = self.resolved.get(name)
+        if params is not None:
+            return params
+
+        # walk up to the first already resolved base (or the root)
+        chain = []
+        while name in self.templates and name not in self.resolved and name not in chain:
+            chain.append(name)
+            name = self.templates[name][0]
+        params = self.resolved.get(name, {})
+
+        # then resolve downwards, memoizing every step
+        for name in reversed(chain):
+            params = dict(params)
+            params.update(self.templates[name][1])
+            self.resolved[name] = params
+        return params
+
+    def get(self, name, key, default=None):
+        '''returns a single (possibly inherited) template param'''
+        return self.params(name).get(key, default)
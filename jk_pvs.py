@@ -0,0 +1,307 @@
+from collections import deque
+import numpy as np
+from .jk_parse import Adjoins
+
+
+# Sector visibility is a portal flow like the vis tool of the Quake
+# compilers: a sector sees another one if a straight line from inside it
+# passes through a chain of render-through adjoin surfaces (portals) into
+# the other one. JK sectors are convex, so the line of sight through a
+# chain source -> pass -> target portal is bounded by the planes through
+# an edge of one portal and a vertex of the other, the target portal is
+# clipped by them before the walk continues behind it. A coarse flood
+# with plane tests only bounds the walk, it is also the result for
+# portals whose walk runs over budget, so the sets stay conservative.
+
+ON_EPSILON = 1e-5           # plane tolerance, relative to the level size
+FLOW_BUDGET = 64            # clip steps per portal before the coarse set is used
+
+class Portals:
+    '''render-through adjoins as directed portals, one row per adjoin
+    surface: the sector it leaves, the one it leads to, its polygon
+    (CSR like Surfaces) and its plane, facing away from the sector'''
+
+    def __init__(self, vertices, surfaces, face_sector, adjoins):
+        '''builds the portals from the world vertices (n, 3), surfaces,
+        the sector of every surface and the adjoins'''
+        adjoin = surfaces.adjoin
+        faces = np.flatnonzero((adjoin > -1) & (adjoin < len(adjoins)) & (face_sector > -1))
+        faces = faces[(adjoins.flags[adjoin[faces]] & Adjoins.VISIBLE) != 0]
+
+        # target sector: the sector of the surface holding the mirror adjoin
+        adjoin_sector = np.full(len(adjoins), -1, dtype=np.int32)
+        adjoined = np.flatnonzero((adjoin > -1) & (adjoin < len(adjoins)))
+        adjoin_sector[adjoin[adjoined]] = face_sector[adjoined]
+        mirror = adjoins.mirror[adjoin[faces]]
+        valid = (mirror > -1) & (mirror < len(adjoins))
+        target = np.where(valid, adjoin_sector[np.where(valid, mirror, 0)], -1)
+        keep = (target > -1) & (target != face_sector[faces])
+        faces = faces[keep]
+        self.source = face_sector[faces].astype(np.int32)
+        self.target = target[keep].astype(np.int32)
+
+        # polygons, gathered from the surface loops
+        self.count = surfaces.loop_total[faces]
+        self.start = (np.cumsum(self.count) - self.count).astype(np.int32)
+        loops = np.repeat(surfaces.loop_start[faces] - self.start, self.count) + np.arange(self.count.sum())
+        self.points = np.asarray(vertices, dtype=np.float64)[surfaces.vertex_indices[loops]]
+
+        # plane normals (Newell), oriented away from the mean of all
+        # surface vertices of the source sector, which is inside it
+        loop_sector = face_sector[surfaces.loop_face]
+        inside = loop_sector > -1
+        all_points = np.asarray(vertices, dtype=np.float64)[surfaces.vertex_indices[inside]]
+        weight = np.bincount(loop_sector[inside])
+        centroid = np.stack([
+            np.bincount(loop_sector[inside], all_points[:, axis], len(weight))
+            for axis in range(3)], axis=1) / np.maximum(weight, 1)[:, None]
+
+        following = np.arange(len(self.points)) + 1
+        following[self.start + self.count - 1] = self.start
+        cross = np.cross(self.points, self.points[following])
+        normal = np.add.reduceat(cross, self.start, axis=0) if len(faces) else np.zeros((0, 3))
+        length = np.linalg.norm(normal, axis=1)
+        normal /= np.maximum(length, 1e-30)[:, None]
+        middle = np.add.reduceat(self.points, self.start, axis=0) / np.maximum(self.count, 1)[:, None] \
+            if len(faces) else np.zeros((0, 3))
+        behind = np.einsum('ij,ij->i', normal, centroid[self.source] - middle) > 0
+        normal[behind] *= -1
+        self.normal = normal
+        self.dist = np.einsum('ij,ij->i', normal, middle)
+
+        extent = np.ptp(self.points, axis=0).max() if len(self.points) else 1.0
+        self.epsilon = ON_EPSILON * max(extent, 1e-6)
+        # degenerate polygons lead to their target, but not further
+        self.flat = (self.count < 3) | (length < self.epsilon * self.epsilon)
+
+    def __len__(self):
+        return len(self.source)
+
+    def polygon(self, portal):
+        return self.points[self.start[portal]:self.start[portal] + self.count[portal]]
+
+
+def clip_polygon(points, normal, dist, epsilon):
+    '''part of a convex polygon (n, 3) in front of a plane, None if
+    nothing but a sliver within epsilon of it remains'''
+    side = points @ normal - dist - epsilon
+    front = side > 0
+    if front.all():
+        return points
+    if not front.any():
+        return None
+    clipped = []
+    count = len(points)
+    for i in range(count):
+        j = (i + 1) % count
+        if front[i]:
+            clipped.append(points[i])
+        if front[i] != front[j]:
+            clipped.append(points[i] + (points[j] - points[i]) * (side[i] / (side[i] - side[j])))
+    if len(clipped) < 3:
+        return None
+    return np.array(clipped)
+
+
+def clip_to_separators(source, pass_, target, flip, epsilon):
+    '''clips target by the planes through an edge of source and a vertex
+    of pass that have source and pass on opposite sides, keeping the side
+    of pass (of source with flip)'''
+    edge = np.repeat(np.roll(source, -1, axis=0) - source, len(pass_), axis=0)
+    offset = (pass_[None, :, :] - source[:, None, :]).reshape((-1, 3))
+    normal = edge[:, [1, 2, 0]] * offset[:, [2, 0, 1]] - edge[:, [2, 0, 1]] * offset[:, [1, 2, 0]]
+    length = np.sqrt((normal * normal).sum(axis=1))
+    normal /= np.maximum(length, 1e-30)[:, None]
+    pass_side = normal @ pass_.T
+    dist = pass_side[np.arange(len(normal)), np.tile(np.arange(len(pass_)), len(source))]
+    pass_side -= dist[:, None]
+
+    # the source polygon is convex, it is on one side of the planes
+    source_side = normal @ source.T - dist[:, None]
+    source_front = (source_side > epsilon).any(axis=1)
+    source_back = (source_side < -epsilon).any(axis=1)
+    sign = np.where(source_front, -1.0, 1.0)
+    pass_side *= sign[:, None]
+
+    # separating if pass is entirely on the front side
+    separating = (source_front | source_back) & (length > epsilon * epsilon)
+    separating &= (pass_side >= -epsilon).all(axis=1) & (pass_side > epsilon).any(axis=1)
+    if flip:
+        sign = -sign
+    normal = normal[separating] * sign[separating, None]
+    dist = dist[separating] * sign[separating]
+
+    # only the planes cutting the target need clipping
+    cutting = ((target @ normal.T - dist) <= epsilon).any(axis=0)
+    for plane in np.flatnonzero(cutting):
+        target = clip_polygon(target, normal[plane], dist[plane], epsilon)
+        if target is None:
+            return None
+    return target
+
+
+def might_see(portals, sector_count):
+    '''coarse visibility of every portal as a sector bitset (int): the
+    sectors reachable through portals partly in front of it that have it
+    partly behind them, a superset of what the flow can reach'''
+    count = len(portals)
+    epsilon = portals.epsilon
+    starts = portals.start
+    front = np.zeros((count, count), dtype=bool)      # q partly in front of p
+    back = np.zeros((count, count), dtype=bool)       # q partly behind p
+    for chunk in range(0, count, 256):
+        side = portals.normal[chunk:chunk + 256] @ portals.points.T - portals.dist[chunk:chunk + 256, None]
+        front[chunk:chunk + 256] = np.maximum.reduceat(side, starts, axis=1) > epsilon
+        back[chunk:chunk + 256] = np.minimum.reduceat(side, starts, axis=1) < -epsilon
+    allowed = front & back.T
+    del front, back
+
+    outgoing = [[] for sector in range(sector_count)]
+    for portal in np.flatnonzero(~portals.flat):
+        outgoing[portals.source[portal]].append(portal)
+
+    mightsee = []
+    for portal in range(count):
+        seen = 1 << int(portals.target[portal])
+        if not portals.flat[portal]:
+            queue = [portals.target[portal]]
+            row = allowed[portal]
+            while queue:
+                for following in outgoing[queue.pop()]:
+                    target = int(portals.target[following])
+                    if row[following] and not (seen >> target) & 1:
+                        seen |= 1 << target
+                        queue.append(target)
+        mightsee.append(seen)
+    return mightsee, outgoing
+
+
+def visible_sets(portals, sector_count, max_depth=0):
+    '''potentially visible set of every sector from a portal flow through
+    the render-through adjoins (Portals). max_depth > 0 stops the walk
+    after that many portals, an approximation that can miss far sectors.
+    Returns the sets as bitsets, one int per sector'''
+    mightsee, outgoing = might_see(portals, sector_count)
+    epsilon = portals.epsilon
+    # what is seen through a portal, narrowed from the coarse set to the
+    # flow result once it is done
+    portal_vis = list(mightsee)
+
+    def flow(base):
+        '''sectors seen through one portal, walked depth first'''
+        seen = 1 << int(portals.target[base])
+        normal, dist = portals.normal[base], portals.dist[base]
+        source = portals.polygon(base)
+        stack = [(int(portals.target[base]), source, source, base, mightsee[base],
+                  (1 << int(portals.source[base])) | seen, 1)]
+        steps = 0
+        while stack:
+            sector, source, pass_, pass_portal, might, path, depth = stack.pop()
+            if max_depth and depth >= max_depth:
+                continue
+            for portal in outgoing[sector]:
+                target_sector = int(portals.target[portal])
+                if not (might >> target_sector) & 1 or (path >> target_sector) & 1:
+                    continue
+                more = might & portal_vis[portal]
+                if not more & ~seen and (seen >> target_sector) & 1:
+                    continue
+                steps += 1
+                if steps > FLOW_BUDGET:
+                    # too many chains, fall back to the coarse set
+                    return seen | mightsee[base]
+
+                # target beyond the base and the pass portal,
+                # source window on this side of the target
+                target = clip_polygon(portals.polygon(portal), normal, dist, epsilon)
+                if target is not None and pass_portal != base:
+                    target = clip_polygon(target, portals.normal[pass_portal],
+                                          portals.dist[pass_portal], epsilon)
+                if target is None:
+                    continue
+                window = clip_polygon(source, -portals.normal[portal], -portals.dist[portal], -epsilon)
+                if window is None:
+                    continue
+                if pass_portal != base:
+                    target = clip_to_separators(window, pass_, target, False, epsilon)
+                    if target is None:
+                        continue
+                    target = clip_to_separators(pass_, window, target, True, epsilon)
+                    if target is None:
+                        continue
+                seen |= 1 << target_sector
+                stack.append((target_sector, window, target, portal, more,
+                              path | (1 << target_sector), depth + 1))
+        return seen
+
+    # portals that see least first, their results prune the later flows
+    visible = [1 << sector for sector in range(sector_count)]
+    order = sorted(range(len(portals)), key=lambda portal: bin(mightsee[portal]).count("1"))
+    for portal in order:
+        if not portals.flat[portal]:
+            portal_vis[portal] = flow(portal)
+        visible[portals.source[portal]] |= portal_vis[portal]
+    return visible
+
+
+def sector_clusters(indptr, sectors, max_size):
+    '''groups adjacent sectors (CSR sector graph) into clusters of at
+    most max_size sectors, grown breadth first from the lowest unassigned
+    sector. Returns the cluster of every sector'''
+    sector_count = len(indptr) - 1
+    cluster = np.full(sector_count, -1, dtype=np.int32)
+    indptr = np.asarray(indptr).tolist()
+    sectors = np.asarray(sectors).tolist()
+    clusters = 0
+    for seed in range(sector_count):
+        if cluster[seed] > -1:
+            continue
+        cluster[seed] = clusters
+        queue = deque((seed,))
+        size = 1
+        while queue and size < max_size:
+            sector = queue.popleft()
+            for neighbour in sectors[indptr[sector]:indptr[sector + 1]]:
+                if cluster[neighbour] == -1 and size < max_size:
+                    cluster[neighbour] = clusters
+                    queue.append(neighbour)
+                    size += 1
+        clusters += 1
+    return cluster
+
+
+def encode_sets(visible, sector_count):
+    '''int bitsets -> (bytes, row width in bytes), one little endian row
+    per sector, stored as a single bytes custom property'''
+    width = (sector_count + 7) // 8
+    return b"".join(bits.to_bytes(width, "little") for bits in visible), width
+
+
+def decode_set(pvs, width, sector, sector_count):
+    '''row of one sector in the pvs bytes -> bool array over all sectors'''
+    bits = np.frombuffer(pvs, dtype=np.uint8, count=width, offset=sector*width)
+    return np.unpackbits(bits, count=sector_count, bitorder="little").astype(bool)
+
+
+def containing_sectors(boundbox, point):
+    '''returns the sectors whose bounding box (n, 6) contains point'''
+    point = np.asarray(point, dtype=np.float32)
+    inside = np.all((boundbox[:, :3] <= point) & (point <= boundbox[:, 3:]), axis=1)
+    return np.flatnonzero(inside)
+
+
+def visible_from(level, point):
+    '''bool array of the sectors of a level (scene["jk_levels"] entry)
+    visible from point, the union over all sectors containing it.
+    None if the point is in no sector'''
+    sector_count = level["sector_count"]
+    boundbox = np.array(level["sector_boundbox"], dtype=np.float32).reshape((-1, 6))
+    inside = containing_sectors(boundbox, point)
+    if len(inside) == 0:
+        return None
+    pvs = bytes(level["pvs"])
+    width = level["pvs_width"]
+    visible = np.zeros(sector_count, dtype=bool)
+    for sector in inside:
+        visible |= decode_set(pvs, width, sector, sector_count)
+    return visible
@@ -0,0 +1,111 @@
+import os
+from .import_gob import open_gob, gob_key
+
+
+# archives in the game's "Resource" directory, highest priority first
+
+JK_RESOURCE_GOBS = ("Res2.gob", "Res1hi.gob")
+MOTS_RESOURCE_GOBS = ("JKMRES.GOO",)
+
+ARCHIVE_EXTENSIONS = (".gob", ".goo")
+
+
+class Vfs:
+    '''layered virtual file system over loose directories and GOB/GOO
+    archives. Layers are added in priority order (highest first), a file
+    name is looked up layer by layer in the archive tocs on first use,
+    no merged index of all archive entries is built'''
+
+    def __init__(self, cache_dir=None):
+        '''cache_dir is the toc cache folder passed on to open_gob()'''
+        self.cache_dir = cache_dir
+        self.layers = []        # paths of added directories and archives
+        self.sources = []       # per layer: {lower case name: path} or Gob
+        self.resolved = {}      # lower case file name -> (layer, entry) or None
+
+    def add_layer(self, key, source):
+        self.layers.append(key)
+        self.sources.append(source)
+        # names missing so far may be found in the new layer
+        self.resolved = {
+            name: entry for name, entry in self.resolved.items()
+            if entry is not None
+            }
+
+    def add_directory(self, directory):
+        '''adds all loose files below directory (archives excluded)'''
+        key = gob_key(directory)
+        if key in self.layers or not os.path.isdir(key):
+            return False
+
+        files_index = {}
+        for root, dirs, files in os.walk(key):
+            for file in files:
+                if file.lower().endswith(ARCHIVE_EXTENSIONS):
+                    continue
+                files_index.setdefault(file.lower(), os.path.join(root, file))
+        self.add_layer(key, files_index)
+        return True
+
+    def add_gob(self, gob_file, use_mmap=False):
+        '''adds a GOB/GOO archive, returns False if it doesn't exist.
+        use_mmap maps it, for the game's resource archives'''
+        key = gob_key(gob_file)
+        if key in self.layers:
+            return False
+        try:
+            gob = open_gob(key, self.cache_dir, use_mmap)
+        except FileNotFoundError:
+            print(os.path.basename(key), "not found")
+            return False
+        self.add_layer(key, gob)
+        return True
+
+    def resolve(self, file):
+        '''(layer, entry) of the highest priority layer that has a file,
+        entry is a loose file path or (Gob, offset, length). None if no
+        layer has the file'''
+        name = file.lower()
+        if name in self.resolved:
+            return self.resolved[name]
+        entry = None
+        for layer, source in enumerate(self.sources):
+            if isinstance(source, dict):
+                path = source.get(name)
+                if path is not None:
+                    entry = (layer, path)
+                    break
+            else:
+                # within an archive the last duplicate wins, see Gob.find()
+                found = source.find(file)
+                if found is not None:
+                    entry = (layer, (source,) + found)
+                    break
+        self.resolved[name] = entry
+        return entry
+
+    def find(self, file):
+        '''returns the path of the directory / archive a file is taken from,
+        or None if no layer has the file'''
+        entry = self.resolve(file)
+        if entry is None:
+            return None
+        return self.layers[entry[0]]
+
+    def __contains__(self, file):
+        return self.resolve(file) is not None
+
+    def ungob(self, file):
+        '''takes a file name (any case), returns the file of the highest
+        priority layer that has it. Raises KeyError like Gob.ungob()'''
+        entry = self.resolve(file)
+        if entry is None:
+            raise KeyError(file)
+        layer, entry = entry
+        if isinstance(entry, str):
+            f = open(entry, 'rb')
+            data = f.read()
+            f.close()
+            return data
+        gob, offset, length = entry
+        return gob.read(offset, length)